@@ -1,16 +1,27 @@
 import sys
 import socket
 import msgpack
+import lz4framed
 import argparse
 import inspect
 import traceback
 import pprint
 import _thread
+import threading
 import traceback
+import selectors
+import struct
+import weakref
+import json
 
+from types import FunctionType
 from contextlib import contextmanager
-from time import time
-from select import select
+from functools import partial
+from concurrent.futures import Future
+from itertools import count, islice
+from collections import deque
+from time import time, perf_counter, monotonic
+from selectors import EVENT_READ, EVENT_WRITE
 from ._wizard import wizard
 
 __all__ = [
@@ -25,15 +36,30 @@ __all__ = [
     'app',
     'call',
     'call_ex',
+    'call_async',
+    'gather',
+    'PendingCall',
+    'Batch',
     'connect',
-    'socks'
+    'socks',
+    'batch',
+    'flush',
+    'register_fd',
+    'unregister_fd',
+    'stats',
+    'enable_stats',
+    'dump_stats',
+    'record',
+    'stop_recording',
+    'pin',
+    'unpin'
     ]
 
 app = None
 socks = []
 packs = {}
-objects = {}
-callbacks = {}
+calls = {}
+call_ids = count(1)
 types = {}
 current_socket = None
 reader = None
@@ -41,37 +67,320 @@ log_name = ''
 settings = {}
 master_sock = None
 
+# Connected sockets, the wake socket and any file registered with register_fd
+# stay registered in one selector for their whole lifetime.
+selector = selectors.DefaultSelector()
+writing = set()
+
+# Outbound messages are gathered per socket and written with a single send
+# at the end of a process_messages iteration or of an explicit batch() block.
+# Inside batch() blocking calls do not wait, they are resolved together when
+# the block exits. Each thread has its own batch() block, kept in local.
+# Whatever a socket does not accept stays queued until it becomes writable.
+outbox = {}
+backlog = {}
+outbox_size = 0
+outbox_time = None
+batch_depth = 0
+flush_size = 1 << 16
+flush_interval = 0.05
+
+# Queued messages of a socket wait in lanes drained in order of priority:
+# replies, blocking calls and object state first, then other calls, then
+# bulk data like view frames, then console and log output, which also takes
+# deletes so they follow everything sent about the object. Each method
+# always goes to the same lane, so calls of one method stay in order. Lanes
+# are looked at again after every write_chunk bytes taken into active[sock].
+# Bulk messages over chunk[sock] bytes are split into 'chunk' messages,
+# which other lanes can pass, if the peer accepts them during connect().
+LANE_CONTROL = 0
+LANE_INTERACTIVE = 1
+LANE_BULK = 2
+LANE_LOG = 3
+bulk_methods = {'_update'}
+log_methods = {'stdout', 'stderr', 'app_log', 'log', 'delete'}
+write_chunk = 1 << 16
+active = {}
+chunk = {}
+chunk_heads = {v: msgpack.packb([None, 'chunk', None, v])[1:]
+    for v in (False, True)}
+
+# Each socket reads into its own reusable buffer, which doubles in size up to
+# recv_max whenever a read fills it completely. read_stats counts reads and
+# bytes read from all sockets and holds the largest buffer size.
+rbufs = {}
+fed = {}
+recv_size = 1 << 12
+read_stats = {'reads': 0, 'bytes': 0, 'buffer_max': recv_size}
+recv_max = 1 << 22
+message_max = 2 ** 31 - 1
+
+# A socket reads at most read_budget bytes per event. Received messages wait
+# in pending_in, handled turn_messages at a time from each socket in turn
+# until tick_budget seconds pass or a timer is due, the rest in next ticks.
+read_budget = 1 << 22
+pending_in = {}
+turn_messages = 64
+tick_budget = 0.01
+
+# Messages of at least compress[sock] bytes are sent to that socket as lz4
+# frames wrapped in an EXT_LZ4 ext type, smaller ones go as is. Compression
+# is off unless the peer accepts it during connect().
+EXT_LZ4 = 1
+compress = {}
+lz4_bytes = {'raw': 0, 'lz4_in': 0, 'lz4_out': 0}
+
+# Buffer arguments of at least oob[sock] bytes are replaced in the message by
+# an EXT_OOB descriptor holding their size and written right after it without
+# being copied. Received buffers are handed to handlers as memoryviews.
+EXT_OOB = 2
+oob = {}
+oobs = {}
+oob_views = []
+iov_max = 1024
+scatter = hasattr(socket.socket, 'sendmsg')
+
+# Object references are sent as EXT_OBJECT holding the handle when all peers
+# accept it during connect(), as {'__object__': handle} maps otherwise. Both
+# are accepted inbound from a socket until it accepts EXT_OBJECT or
+# legacy_refs is turned off, which lets received maps skip object_hook.
+# hooked holds sockets read by unpackers with object_hook. Every thread
+# packs with its own reused Packer.
+EXT_OBJECT = 3
+ref_socks = set()
+ext_refs = False
+legacy_refs = True
+hooked = set()
+local = threading.local()
+
+# Objects are known to DICE by small handles. They are held weakly unless
+# pinned, objects collected by Python are deleted in DICE in batches.
+objects = {}
+handles = {}
+type_handles = {}
+pins = {}
+collected = []
+unknown_refs = []
+next_handle = count(1)
+
+# Peers which accept snapshots get all types, objects and property values in
+# one message when they connect, objects then connect without round trips.
+snapshot_socks = set()
+type_records = {}
+in_snapshot = False
+
+# Calls made by other threads are encoded by them and queued for the loop
+# thread, which is woken once per batch of them. Only the loop thread writes
+# sockets, coalesce() and flush() do nothing in other threads.
+posted = deque()
+posted_lock = threading.Lock()
+posted_wake = False
+
+# Resilient mode, see --dice-reconnect. While the master connection is down
+# messages for it are queued up to offline_max bytes, oldest dropped first.
+# Messages carrying object state are not queued, connect() sends current
+# state anew. Calls which were waiting for results are sent again.
+reconnect = None
+reconnect_delay = 0.1
+reconnect_delay_max = 5.0
+reconnect_give_up = 300.0
+reconnect_since = None
+reconnect_wait = None
+offline = deque()
+offline_size = 0
+offline_max = 1 << 22
+offline_dropped = 0
+state_methods = {
+    'result', 'error', 'register', 'new', 'delete', 'snapshot',
+    '__dice_set_property__', 'set_running', 'set_tasks', 'x_model_reset',
+    'x_set_current', 'x_model_move_items', 'x_model_insert_items',
+    'x_model_remove_items', 'x_model_update_item', 'x_model_select'
+    }
+
+# Peers with more unsent bytes than this are disconnected, except the master
+# connection, which instead makes the sender wait until it catches up.
+high_water = 1 << 26
+
+# RPC instrumentation, off unless enabled with enable_stats or --dice-stats.
+# Outbound calls are counted per method name, inbound ones per dispatch
+# target, round trips per name of the awaited call.
+stats_enabled = False
+stats_path = None
+out_stats = {}
+in_stats = {}
+rtt_stats = {}
+
+# Session recording, see record(). The file holds a header map followed by
+# [seconds, socket number, 'in' or 'out', encoded message] arrays.
+recorder = None
+record_start = 0.0
+record_socks = {}
+
+
+class Histogram:
+    """
+    Durations in power of two buckets of microseconds.
+    """
+
+    __slots__ = 'count', 'total', 'max', 'buckets'
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * 40
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        self.buckets[min(int(seconds * 1e6).bit_length(), 39)] += 1
+
+    def percentile(self, q):
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if n and seen >= rank:
+                return min((1 << i) * 1e-6, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'total': self.total,
+            'mean': self.total / self.count if self.count else 0.0,
+            'max': self.max,
+            'p50': self.percentile(0.5),
+            'p90': self.percentile(0.9),
+            'p99': self.percentile(0.99),
+            'buckets_us': {(1 << i): n
+                for i, n in enumerate(self.buckets) if n}
+            }
+
 
 def dump_hook(obj):
-    object_id = id(obj)
-    if object_id in objects:
-        return {'__object__': object_id}
+    if isinstance(obj, Unknown):
+        return {'__object__': obj.handle}
+    handle = handle_of(obj)
+    if handle is not None:
+        if ext_refs:
+            return msgpack.ExtType(EXT_OBJECT,
+                handle.to_bytes((handle.bit_length() + 7) // 8, 'big'))
+        return {'__object__': handle}
+    return obj
+
+
+def pack(data):
+    """
+    Encodes data with the Packer of the calling thread.
+    """
+    try:
+        packer = local.packer
+    except AttributeError:
+        packer = local.packer = msgpack.Packer(default = dump_hook,
+            use_bin_type=True)
+    return packer.pack(data)
+
+
+class Unknown:
+    """
+    Received reference to an object which is collected or never existed.
+    Messages holding such references are rejected.
+    """
+
+    __slots__ = 'handle',
+
+    def __init__(self, handle):
+        self.handle = handle
+
+    def __repr__(self):
+        return 'Unknown(%r)' % self.handle
+
+
+def resolve(handle):
+    entry = objects.get(handle)
+    obj = entry[0]() if entry is not None else None
+    if obj is None:
+        unknown_refs.append(handle)
+        return Unknown(handle)
     return obj
 
 
 def load_hook(data):
     obj = data.get('__object__')
     if obj != None:
-        return objects[obj][0]
+        return resolve(obj)
+    return data
+
+
+def handle_of(obj):
+    handle = handles.get(id(obj))
+    if handle is not None and objects[handle][0]() is obj:
+        return handle
+    return None
+
+
+def ext_hook(code, data):
+    if code == EXT_OBJECT:
+        return resolve(int.from_bytes(data, 'big'))
+    if code == EXT_LZ4:
+        return msgpack.unpackb(lz4framed.decompress(data),
+            object_hook=load_hook if legacy_refs else None,
+            ext_hook=ext_hook, raw=False)
+    if code == EXT_OOB:
+        view = memoryview(bytearray(struct.unpack('>Q', data)[0]))
+        oob_views.append(view)
+        return view
+    return msgpack.ExtType(code, data)
+
+
+def split_buffers(args, limit):
+    buffers = []
+
+    def take(v):
+        if isinstance(v, (bytes, bytearray, memoryview)):
+            v = memoryview(v)
+            if v.nbytes >= limit and v.c_contiguous:
+                v = v.cast('B')
+                if not v.readonly:
+                    # sent later, changes made meanwhile must not reach it
+                    v = memoryview(bytes(v))
+                buffers.append(v)
+                return msgpack.ExtType(EXT_OOB, struct.pack('>Q', v.nbytes))
+        return v
+
+    result = []
+    for v in args:
+        if type(v) in (list, tuple):
+            v = [take(i) for i in v]
+        elif isinstance(v, (bytes, bytearray, memoryview)):
+            v = take(v)
+        result.append(v)
+    if buffers:
+        return tuple(result), buffers
+    return args, None
+
+
+def compress_message(message):
+    data = msgpack.packb(msgpack.ExtType(
+        EXT_LZ4, lz4framed.compress(message)), use_bin_type=True)
+    if len(data) >= len(message):
+        return message
     return data
 
 
 def handle_result(call_id, value = None):
-    count, callback = callbacks[call_id]
-    if count == 1:
-        del callbacks[call_id]
-    else:
-        callbacks[call_id] = (count - 1, callback)
-    callback(value)
+    future = calls.pop(call_id, None)
+    if future is not None:
+        future.resolve(value)
 
 
 def handle_error(call_id, value = None):
-    count, callback = callbacks[call_id]
-    if count == 1:
-        del callbacks[call_id]
-    else:
-        callbacks[call_id] = (count - 1, callback)
-    callback(Exception('DICE call error'))
+    future = calls.pop(call_id, None)
+    if future is not None:
+        future.resolve(Exception('DICE call error'))
 
 
 def handle_settigs(value):
@@ -79,136 +388,771 @@ def handle_settigs(value):
     settings = value
 
 
+handlers = {
+    'result': handle_result,
+    'error': handle_error,
+    'settigs': handle_settigs,
+    }
+
+# Methods DICE may call on objects, per class. Besides public methods and
+# declared slots only these special methods are allowed. Public names
+# missing from the table, like methods wrapped by lru_cache or partialmethod
+# and callables set on instances, are looked up on the object itself.
+dispatch = {}
+remote_specials = {'__dice_sync_props__', '__dice_sync_value__'}
+
+
+def bind_method(descriptor, obj, *args):
+    return descriptor.__get__(obj, type(obj))(*args)
+
+
+def call_attribute(name, obj, *args):
+    return getattr(obj, name)(*args)
+
+
+def find_method(obj, name):
+    table = dispatch.get(type(obj))
+    if table is None:
+        table = dispatch_table(type(obj))
+    method = table.get(name)
+    if method is None and not name.startswith('_'):
+        if callable(getattr(obj, name, None)):
+            method = partial(call_attribute, name)
+    return method
+
+
+def dispatch_table(cls):
+    slots = {v['method_name'] for v in getattr(cls, '__dice_slots__', ())}
+    table = {}
+    for klass in reversed(cls.__mro__):
+        for name, attr in vars(klass).items():
+            if (name.startswith('_') and name not in remote_specials
+                    and name not in slots):
+                continue
+            if isinstance(attr, FunctionType):
+                table[name] = attr
+            elif (name in slots
+                    or isinstance(attr, (staticmethod, classmethod))):
+                table[name] = partial(bind_method, attr)
+            else:
+                table.pop(name, None)
+    dispatch[cls] = table
+    return table
+
+
+class PendingCall(Future):
+    """
+    Future of a call waiting for its result. Calls are identified by
+    monotonically increasing ids. A timed out call fails with TimeoutError,
+    a cancelled one ignores its result.
+    """
+
+    def __init__(self, name, timeout=None):
+        super().__init__()
+        self.name = name
+        self.call_id = next(call_ids)
+        self.timer = None
+        self.timeout = timeout
+        self.message = None
+        self.started = perf_counter() if stats_enabled else None
+        calls[self.call_id] = self
+        if timeout is not None and not off_thread():
+            self.start_timer()
+
+    def start_timer(self):
+        if self.timeout is not None and self.timer is None and not self.done():
+            self.timer = wizard.timeout(self.expire, self.timeout)
+
+    def resolve(self, value):
+        self.stop_timer()
+        if self.done():
+            return
+        if self.started is not None and stats_enabled:
+            hist = rtt_stats.get(self.name)
+            if hist is None:
+                hist = rtt_stats[self.name] = Histogram()
+            hist.add(perf_counter() - self.started)
+        if isinstance(value, Exception):
+            self.set_exception(value)
+        else:
+            self.set_result(value)
+
+    def expire(self):
+        self.timer = None
+        if calls.pop(self.call_id, None) is not None:
+            self.resolve(TimeoutError('DICE call timed out: %s' % self.name))
+
+    def cancel(self):
+        calls.pop(self.call_id, None)
+        self.stop_timer()
+        return super().cancel()
+
+    def stop_timer(self):
+        if self.timer is not None:
+            wizard.remove_timeout(self.timer)
+            self.timer = None
+
+
+def notify_callback(callback, future):
+    if not future.cancelled():
+        callback(future.exception() or future.result())
+
+
 def call(obj, name, *args, **kwargs):
+    global posted_wake
+    if obj is not None:
+        handle = handle_of(obj)
+        if handle is None:
+            future = kwargs.get('future')
+            if future is not None:
+                future.cancel()
+            raise ValueError('object is not instantiated: %r' % (obj,))
+        obj = handle
     callback = kwargs.get('callback')
     if callback:
-        call_id = id(callback)
-        info = callbacks.get(call_id)
-        if info:
-            callbacks[call_id] = (info[0] + 1, callback)
-        else:
-            callbacks[call_id] = (1, callback)
+        future = PendingCall(name, kwargs.get('timeout'))
+        future.add_done_callback(partial(notify_callback, callback))
+        call_id = future.call_id
     else:
-        call_id = None
-
-    data = (id(obj) if obj is not None else None, name, call_id) + args
-    message = msgpack.packb(data, default = dump_hook, use_bin_type=True)
-    send(message, kwargs.get('mode', 0))
+        future = kwargs.get('future')
+        call_id = future.call_id if future else None
+
+    mode = kwargs.get('mode', 0)
+    inline = args
+    buffers = None
+    if oob and len(oob) == len(socks):
+        args, buffers = split_buffers(args, max(oob.values()))
+
+    data = (obj, name, call_id) + args
+    message = pack(data)
+    if buffers:
+        inline = (obj, name, call_id) + inline
+    else:
+        inline = None
+
+    if off_thread():
+        # encoded here, written by the loop thread
+        with posted_lock:
+            posted.append((name, message, mode, buffers, future, inline))
+            wake = not posted_wake
+            posted_wake = True
+        if wake:
+            wizard.wake()
+    else:
+        emit(name, message, mode, buffers, future, inline)
 
 
-def call_ex(obj, name, *args):
-    result = None
-    finished = False
+def off_thread():
+    return (wizard.thread_ident is not None
+        and wizard.thread_ident != _thread.get_ident())
 
-    def callback(x):
-        nonlocal finished
-        nonlocal result
-        finished = True
-        result = x
 
-    call(obj, name, *args, callback=callback, mode=3)
-    wait(lambda: finished)
-    if isinstance(result, Exception):
-        raise result
-    return result
+def emit(name, message, mode, buffers, future, inline):
+    if future is not None and prop_changes:
+        # the peer sees state changed before the call as it was
+        flush_props()
+    if reconnect is not None and mode in (0, 3) and name not in state_methods:
+        if inline is not None:
+            data = pack(inline)
+        else:
+            data = message
+        if future is not None:
+            future.message = data
+        if master_sock is None:
+            queue_offline(data)
+    if stats_enabled:
+        entry = out_stats.get(name)
+        if entry is None:
+            entry = out_stats[name] = [0, 0]
+        entry[0] += 1
+        entry[1] += len(message) + sum(len(v) for v in buffers or ())
+    send(message, mode, buffers, lane_of(name, future))
+
+
+def lane_of(name, future):
+    if name in log_methods:
+        return LANE_LOG
+    if future is not None or name in state_methods:
+        return LANE_CONTROL
+    if name in bulk_methods:
+        return LANE_BULK
+    return LANE_INTERACTIVE
+
+
+def split_chunks(pieces, size, limit):
+    """
+    Splits message bytes into 'chunk' messages of at most limit bytes of
+    data each, without copying them.
+    """
+    views = deque(memoryview(v).cast('B') for v in pieces)
+    chunks = []
+    while size:
+        n = min(size, limit)
+        size -= n
+        part = [b'\x95' + chunk_heads[not size] + struct.pack('>BI', 0xc6, n)]
+        total = len(part[0]) + n
+        while n:
+            v = views.popleft()
+            if len(v) > n:
+                views.appendleft(v[n:])
+                v = v[:n]
+            part.append(v)
+            n -= len(v)
+        chunks.append((total, part))
+    return chunks
+
+
+def send_posted():
+    """
+    Writes calls made by other threads.
+    """
+    global posted_wake
+    with posted_lock:
+        posted_wake = False
+    if not posted:
+        return
+    with coalesce():
+        while posted:
+            item = posted.popleft()
+            emit(*item)
+            if item[4] is not None:
+                item[4].start_timer()
+
+
+def call_async(obj, name, *args, timeout=None, mode=3):
+    """
+    Sends call without waiting for its result.
+
+    :param timeout: Seconds to wait for result before the call fails with
+        TimeoutError.
+    :return PendingCall: Future which gets result of the call.
+    """
+    future = PendingCall(name, timeout)
+    call(obj, name, *args, future=future, mode=mode)
+    return future
+
+
+def call_ex(obj, name, *args, timeout=None):
+    future = call_async(obj, name, *args, timeout=timeout)
+    b = getattr(local, 'batch', None)
+    if b is not None:
+        b.calls.append(future)
+        return future
+    if off_thread():
+        return future.result()
+    wait(future.done)
+    return future.result()
+
+
+def gather(futures):
+    """
+    Processes messages until all futures are done. Off the loop thread it
+    just waits for them.
+
+    :param futures: Futures returned by call_async.
+    :return list: Results in the order of futures.
+    """
+    futures = list(futures)
+    if not off_thread():
+        wait(lambda: all(f.done() for f in futures))
+    return [f.result() for f in futures]
 
 
 def instantiate(obj, type_name):
-    object_id = id(obj)
-    objects[object_id] = (obj, type_name)
+    handle = handle_of(obj)
+    if handle is None:
+        handle = next(next_handle)
+        object_id = id(obj)
+        try:
+            ref = weakref.ref(obj,
+                lambda r: collected.append((handle, object_id)))
+        except TypeError:
+            ref = lambda: obj
+        handles[object_id] = handle
+    else:
+        ref = objects[handle][0]
+    objects[handle] = (ref, type_name)
     if socks:
         register_type(obj)
         create_object(obj, type_name)
 
 
+def pin(obj):
+    """
+    Keeps object alive until it is unpinned or deleted, otherwise objects
+    are deleted in DICE once nothing else references them. Objects which
+    are not instantiated raise ValueError.
+    """
+    handle = handle_of(obj)
+    if handle is None:
+        raise ValueError('object is not instantiated: %r' % (obj,))
+    pins[handle] = obj
+    return obj
+
+
+def unpin(obj):
+    pins.pop(handle_of(obj), None)
+
+
+def release_collected():
+    while collected:
+        handle, object_id = collected.pop()
+        if objects.pop(handle, None) is not None:
+            call(None, 'delete', handle)
+        if handles.get(object_id) == handle:
+            del handles[object_id]
+
+
+def type_handle(cls):
+    handle = type_handles.get(cls)
+    if handle is None:
+        handle = type_handles[cls] = len(type_handles) + 1
+    return handle
+
+
+def type_record(cls):
+    record = type_records.get(cls)
+    if record is None:
+        record = type_records[cls] = (type_handle(cls), cls.__name__,
+            cls.__dice_slots__, cls.__dice_signals__, cls.__dice_properties__)
+    return record
+
+
 def register_type(obj):
     cls = type(obj)
-    type_id = id(cls)
+    if cls not in dispatch:
+        dispatch_table(cls)
     for s in socks:
         if cls not in types[s]:
-            call(None, 'register', type_id, cls.__name__, cls.__dice_slots__,
-                cls.__dice_signals__, cls.__dice_properties__)
+            with set_socket(s):
+                call(None, 'register', *type_record(cls), mode=1)
             types[s].add(cls)
 
 
 def create_object(obj, type_name, mode=0):
-    object_id = id(obj)
-    cls = type(obj)
-    type_id = id(cls)
-    call(None, 'new', object_id, type_id, type_name, mode=mode)
+    call(None, 'new', handle_of(obj), type_handle(type(obj)), type_name,
+        mode=mode)
 
 
 def delete(obj):
-    object_id = id(obj)
-    call(None, 'delete', object_id)
-    del objects[object_id]
+    handle = handle_of(obj)
+    with prop_lock:
+        for key in [k for k in prop_changes if k[0] == id(obj)]:
+            del prop_changes[key]
+    call(None, 'delete', handle)
+    del objects[handle]
+    del handles[id(obj)]
+    pins.pop(handle, None)
 
 stdout_write_old = sys.stdout.write
 stderr_write_old = sys.stderr.write
 
-stdout_data = ''
-stderr_data = ''
+# Console output of all threads is gathered as complete lines in order they
+# were completed. A line is forwarded at once if nothing was forwarded in
+# the last console_interval seconds, lines of a burst are held until the
+# interval ends or console_size bytes are pending. If console_rate is set,
+# lines over that many per second are dropped and reported as suppressed.
+# Held lines and unfinished ones are sent by flush_output() when run() ends.
+console_lock = threading.Lock()
+console_partial = {'stdout': '', 'stderr': ''}
+console_lines = []
+console_pending = 0
+console_time = None
+console_sent = 0.0
+console_interval = 0.05
+console_size = 1 << 16
+console_rate = None
+console_window = 0.0
+console_count = 0
+console_dropped = 0
+
+# Property changes are held per object and property, only the latest value
+# is sent. They go out when the tick they were made in ends, or inside a
+# long tick every flush_interval seconds, but not before prop_interval
+# seconds since the first of them. While the master connection has more
+# than prop_pressure unsent bytes, prop_interval_busy applies instead.
+prop_lock = threading.Lock()
+prop_changes = {}
+prop_time = None
+prop_interval = 0.0
+prop_interval_busy = 0.25
+prop_pressure = 1 << 20
+prop_merged = 0
+
+
+def console_write(stream, data):
+    global console_pending
+    global console_time
+    global console_window
+    global console_count
+    global console_dropped
+
+    with console_lock:
+        text = console_partial[stream] + data
+        end = text.rfind('\n')
+        if end < 0:
+            console_partial[stream] = text
+            return
+        console_partial[stream] = text[end + 1:]
+        text = text[:end]
+
+        now = monotonic()
+        lines = text.count('\n') + 1
+        if console_rate is not None:
+            if now - console_window >= 1:
+                report_dropped()
+                console_window = now
+                console_count = 0
+            allowed = max(console_rate - console_count, 0)
+            if lines > allowed:
+                text = '\n'.join(text.split('\n', allowed)[:allowed])
+                console_dropped += lines - allowed
+                lines = allowed
+            console_count += lines
+        if lines:
+            console_lines.append((stream, text))
+            console_pending += len(text)
+        elif console_time is not None:
+            return
+
+        first = console_time is None
+        if first:
+            console_time = now
+        delay = max(console_sent + console_interval - now, 0)
+        due = console_pending >= console_size or not delay
 
+    if wizard.thread_ident != _thread.get_ident():
+        # one wake per interval, the timer is armed on the main thread
+        if first:
+            wizard.w_console_pending(delay)
+    elif due:
+        flush_console()
+    elif first:
+        w_console_pending(delay)
+
+
+def report_dropped():
+    global console_dropped
+    if console_dropped:
+        console_lines.append(('stderr',
+            '[%i lines suppressed]' % console_dropped))
+        console_dropped = 0
+
+
+def w_console_pending(delay=None):
+    wizard.timeout(flush_console, console_interval if delay is None else delay)
+
+
+def flush_console():
+    global console_pending
+    global console_time
+    global console_sent
+
+    with console_lock:
+        delay = console_window + 1 - monotonic()
+        if delay <= 0:
+            report_dropped()
+        lines = console_lines[:]
+        del console_lines[:]
+        console_pending = 0
+        console_time = None
+        if lines:
+            console_sent = monotonic()
+        if console_dropped:
+            # report suppressed lines when the rate window ends
+            console_time = monotonic()
+            if off_thread():
+                wizard.w_console_pending(delay)
+            else:
+                w_console_pending(delay)
+    if not lines:
+        return
+
+    with coalesce():
+        stream, text = lines[0]
+        for v, line in lines[1:]:
+            if v == stream:
+                text += '\n' + line
+            else:
+                call(None, stream, text)
+                stream, text = v, line
+        call(None, stream, text)
+
+
+def flush_output():
+    """
+    Sends held console output, unfinished lines too, and writes whatever
+    sockets accept of queued messages. Called when the loop ends.
+    """
+    with console_lock:
+        report_dropped()
+        for stream, text in console_partial.items():
+            if text:
+                console_lines.append((stream, text))
+                console_partial[stream] = ''
+    try:
+        flush_console()
+        flush()
+    except (ConnectionLost, OSError):
+        pass
 
-def w_stdout_write(data):
-    global stdout_data
-    if data:
-        data = data.rsplit('\n', 1)
-        if len(data) > 1:
-            message = msgpack.packb(( None, 'stdout', None, stdout_data+data[0]), use_bin_type=True)
-            send(message)
-            stdout_data = data[1]
-        else:
-            stdout_data += data[0]
 
+def set_property(obj, name, value):
+    """
+    Sends new property value to all sockets, merged with other changes of
+    the property made before it is sent.
+    """
+    global prop_time
+    global prop_merged
+
+    with prop_lock:
+        now = monotonic()
+        first = not prop_changes
+        if first:
+            prop_time = now
+        key = (id(obj), name)
+        if key in prop_changes:
+            prop_merged += 1
+        prop_changes[key] = (obj, name, value)
+        delay = props_delay()
+        due = now - prop_time >= (
+            max(delay, flush_interval) if batch_depth else delay)
+
+    if off_thread():
+        # one wake per batch of changes, the timer is armed on the main thread
+        if first:
+            wizard.w_props_pending()
+    elif due:
+        flush_props()
+    elif first and delay:
+        w_props_pending()
+
+
+def props_delay():
+    if backlog.get(master_sock, 0) > prop_pressure:
+        return prop_interval_busy
+    return prop_interval
+
+
+def w_props_pending():
+    wizard.timeout(flush_props,
+        max(prop_time + props_delay() - monotonic(), 0)
+        if prop_time is not None else 0)
+
+
+def flush_props():
+    global prop_time
+
+    with prop_lock:
+        changes = list(prop_changes.values())
+        prop_changes.clear()
+        prop_time = None
+    if not changes:
+        return
+    with coalesce():
+        for obj, name, value in changes:
+            call(obj, '__dice_set_property__', name, value)
+
+
+def send(message, mode=0, buffers=None, lane=LANE_INTERACTIVE):
+    global outbox_size
+    global outbox_time
+
+    compressed = None
+    for s in socks:
+        if ((mode == 1 and s == current_socket)
+            or (mode == 2 and s != current_socket)
+            or (mode == 3 and s == master_sock)
+            or not mode):
+            if recorder is not None:
+                record_message(s, 'out', message, buffers)
+            data = message
+            if s in compress and len(message) >= compress[s]:
+                if compressed is None:
+                    compressed = compress_message(message)
+                data = compressed
+            if data is message:
+                lz4_bytes['raw'] += len(data)
+            else:
+                lz4_bytes['lz4_in'] += len(message)
+                lz4_bytes['lz4_out'] += len(data)
+            pieces = (data,)
+            size = len(data)
+            if buffers:
+                pieces += tuple(buffers)
+                size += sum(len(v) for v in buffers)
+            if lane == LANE_BULK and s in chunk and size > chunk[s]:
+                entries = split_chunks(pieces, size, chunk[s])
+                outbox[s][lane].extend(entries)
+                size = sum(n for n, part in entries)
+            else:
+                outbox[s][lane].append((size, pieces))
+            backlog[s] += size
+            outbox_size += size
+
+    if outbox_time is None:
+        outbox_time = monotonic()
+
+    if (not batch_depth or outbox_size >= flush_size
+            or monotonic() - outbox_time >= flush_interval):
+        flush()
+
+    if master_sock in backlog and backlog[master_sock] > high_water:
+        wait(lambda: backlog.get(master_sock, 0) <= high_water // 2)
+
+
+def flush():
+    global outbox_size
+    global outbox_time
+
+    if off_thread():
+        return
+    if prop_changes and monotonic() - prop_time >= props_delay():
+        flush_props()
+    outbox_size = 0
+    outbox_time = None
+    for s in list(outbox):
+        flush_socket(s)
+
+
+def flush_socket(s):
+    if not backlog.get(s):
+        return
+    pieces = active[s]
+    try:
+        while pieces or fill(s, pieces):
+            if scatter:
+                sent = s.sendmsg(pieces[:iov_max])
+            else:
+                if len(pieces) > 1:
+                    pieces[:] = [b''.join(pieces)]
+                sent = s.send(pieces[0])
+            backlog[s] -= sent
+            i = 0
+            while i < len(pieces) and sent >= len(pieces[i]):
+                sent -= len(pieces[i])
+                i += 1
+            del pieces[:i]
+            if sent:
+                pieces[0] = memoryview(pieces[0])[sent:]
+                break
+    except BlockingIOError:
+        pass
+    except OSError:
+        disconnect(s)
+        return
+    if backlog[s]:
+        if s not in writing:
+            writing.add(s)
+            selector.modify(s, EVENT_READ | EVENT_WRITE)
+    elif s in writing:
+        writing.discard(s)
+        selector.modify(s, EVENT_READ)
+    if backlog[s] > high_water and s != master_sock:
+        disconnect(s)
+
+
+def fill(s, pieces):
+    """
+    Takes up to write_chunk bytes of queued messages of socket s, higher
+    lanes first.
+    """
+    size = 0
+    for lane in outbox[s]:
+        while lane and size < write_chunk:
+            n, entry = lane.popleft()
+            pieces.extend(entry)
+            size += n
+    return size
 
-def w_stderr_write(data):
-    global stderr_data
-    if data:
-        data = data.rsplit('\n', 1)
-        if len(data) > 1:
-            message = msgpack.packb(( None, 'stderr', None, stderr_data+data[0]), use_bin_type=True)
-            send(message)
-            stderr_data = data[1]
-        else:
-            stderr_data += data[0]
 
+@contextmanager
+def coalesce():
+    global batch_depth
+    if off_thread():
+        # calls of other threads are posted and written by the loop thread
+        yield
+        return
+    batch_depth += 1
+    try:
+        yield
+    finally:
+        batch_depth -= 1
+        if not batch_depth:
+            flush()
 
-def send(message, mode=0):
 
-    ss = {s: 0 for s in socks
+class Batch:
+    """
+    Blocking calls made inside batch() block. Their results are available
+    when the block exits.
+    """
 
-        if ((mode == 1 and s == current_socket)
-            or (mode == 2 and s != current_socket)
-            or (mode == 3 and s == master_sock)
-            or not mode)
-    }
+    def __init__(self):
+        self.calls = []
+
+    @property
+    def results(self):
+        return [f.result() for f in self.calls]
+
+
+@contextmanager
+def batch():
+    """
+    Gathers messages sent inside the block and writes them to each socket
+    at once. Blocking calls inside the block return PendingCall instead of
+    result, and all of them are waited for in one round trip when the
+    outermost block exits. The block applies to the calling thread only.
+
+    If the block raises, its calls are cancelled: they are still sent and
+    run in DICE, only their results are ignored.
+
+    :return Batch: Calls made in the block.
+    """
+    outer = getattr(local, 'batch', None)
+    if outer is None:
+        local.batch = Batch()
+    b = local.batch
+    try:
+        with coalesce():
+            yield b
+    except:
+        if outer is None:
+            for f in b.calls:
+                f.cancel()
+        raise
+    finally:
+        local.batch = outer
+    if outer is None and b.calls:
+        gather(b.calls)
 
-    while ss:
-        for s in list(ss):
-            ss[s] += s.send(message[ss[s]:])
-            if ss[s] == len(message):
-                del ss[s]
+
+@contextmanager
+def set_batch(b):
+    old_batch = getattr(local, 'batch', None)
+    local.batch = b
+    try:
+        yield
+    finally:
+        local.batch = old_batch
 
 
-wizard.subscribe(w_stdout_write)
-wizard.subscribe(w_stderr_write)
+wizard.subscribe(w_console_pending)
+wizard.subscribe(w_props_pending)
 
 
 def stdout_write(data):
-    stdout_write_old(data)
-    if wizard.thread_ident != _thread.get_ident():
-        wizard.w_stdout_write(data=data)
-    else:
-        w_stdout_write(data=data)
+    result = stdout_write_old(data)
+    if data:
+        console_write('stdout', data)
+    return result
 
 
 def stderr_write(data):
-    stderr_write_old(data)
-    if wizard.thread_ident != _thread.get_ident():
-        wizard.w_stderr_write(data=data)
-    else:
-        w_stderr_write(data=data)
+    result = stderr_write_old(data)
+    if data:
+        console_write('stderr', data)
+    return result
 
 
 def app_settings():
@@ -220,11 +1164,14 @@ def app_log(name):
     global log_name
     old_app_log = log_name
     log_name = name
+    # output goes to the log it was written under
+    flush_console()
     call(None, 'app_log', name)
     try:
         yield
     finally:
         log_name = old_app_log
+        flush_console()
         call(None, 'app_log', old_app_log)
 
 
@@ -252,38 +1199,309 @@ parser.add_argument('--dice-port', required = True, type=int)
 parser.add_argument('--dice-progress', required = True, type=int)
 parser.add_argument('--dice-instance-id', required = True, type=str)
 parser.add_argument('--dice-workflow-dir', required = True, type=str)
-
-
-def connect(addr, port):
+parser.add_argument('--dice-compress', default = None, type=int)
+parser.add_argument('--dice-oob', default = None, type=int)
+parser.add_argument('--dice-snapshot', action = 'store_true')
+parser.add_argument('--dice-reconnect', action = 'store_true')
+parser.add_argument('--dice-refs', action = 'store_true')
+parser.add_argument('--dice-chunk', default = None, type=int)
+parser.add_argument('--dice-stats', default = None, type=str)
+parser.add_argument('--dice-record', default = None, type=str)
+
+
+def connect(addr, port, compress_min=None, oob_min=None, snapshot=False,
+        refs=False, chunk_size=None):
+    """
+    Connects to DICE and sends all objects to it.
+
+    :param compress_min: Ask peer to accept lz4 compressed messages of at
+        least this size in bytes. Compression stays off if peer refuses.
+    :param oob_min: Ask peer to accept buffer arguments of at least this
+        size in bytes out of band. They are sent inline if peer refuses.
+    :param snapshot: Ask peer to accept all objects in one message.
+    :param refs: Ask peer to accept object references as EXT_OBJECT.
+    :param chunk_size: Ask peer to accept bulk messages split into chunks
+        of this size in bytes.
+    """
     global master_sock
     global current_socket
 
     sock = socket.socket()
     sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-    sock.connect((addr, port))
+    try:
+        sock.connect((addr, port))
+    except OSError:
+        sock.close()
+        raise
     message = app.instance_id.encode('utf8') + b'\x00'
     while message:
         message = message[sock.send(message):]
-    socks.append(sock)
-    packs[sock] = msgpack.Unpacker(object_hook = load_hook, encoding='utf-8')
-    types[sock] = set()
+    add_socket(sock)
 
     with set_socket(sock):
         if master_sock is None:
             master_sock = sock
-        for (obj, type_name) in objects.values():
-            register_type(obj)
-        for (obj, type_name) in objects.values():
-            create_object(obj, type_name, mode=1)
-        for (obj, type_name) in objects.values():
-            obj.connect()
+        options = {}
+        if compress_min is not None:
+            options['lz4'] = compress_min
+        if oob_min is not None:
+            options['oob'] = oob_min
+        if snapshot:
+            options['snapshot'] = 1
+        if refs:
+            options['ref'] = 1
+        if chunk_size is not None:
+            options['chunk'] = chunk_size
+        if options:
+            negotiate(sock, options)
+        release_collected()
+        alive = [(ref(), type_name) for ref, type_name in objects.values()]
+        alive = [v for v in alive if v[0] is not None]
+        if sock in snapshot_socks:
+            send_snapshot(sock, alive)
+        else:
+            for (obj, type_name) in alive:
+                register_type(obj)
+            for (obj, type_name) in alive:
+                create_object(obj, type_name, mode=1)
+            with batch():
+                for (obj, type_name) in alive:
+                    obj.connect()
         call(None, 'ready', app, mode=1)
 
 
+def send_snapshot(sock, alive):
+    """
+    Sends types, objects and their property values to the current socket
+    in one message and connects objects without asking DICE.
+    """
+    global in_snapshot
+
+    records = {}
+    properties = []
+    for (obj, type_name) in alive:
+        cls = type(obj)
+        if cls not in records:
+            records[cls] = type_record(cls)
+            if cls not in dispatch:
+                dispatch_table(cls)
+        if cls.__dice_properties__:
+            properties.append((handle_of(obj), {
+                info['attr_name']: getattr(obj, info['attr_name'])
+                for info in cls.__dice_properties__}))
+    call(None, 'snapshot', {
+        'types': list(records.values()),
+        'objects': [(handle_of(obj), type_handle(type(obj)), type_name)
+            for (obj, type_name) in alive],
+        'properties': properties
+        }, mode=1)
+    types[sock].update(records)
+
+    in_snapshot = True
+    try:
+        for (obj, type_name) in alive:
+            obj.connected()
+    finally:
+        in_snapshot = False
+
+
+# Seconds to wait for the answer to 'wire' options. Masters which don't
+# answer in time are taken to accept none of them.
+wire_timeout = 2.0
+
+
+def negotiate(sock, options):
+    reply = []
+    call(None, 'wire', options, callback=reply.append, timeout=wire_timeout,
+        mode=1)
+    wait(lambda: reply or sock not in socks)
+    accepted = reply[0] if reply and isinstance(reply[0], dict) else {}
+    if 'lz4' in options and accepted.get('lz4') is not None:
+        compress[sock] = max(accepted['lz4'], options['lz4'])
+    if 'oob' in options and accepted.get('oob') is not None:
+        oob[sock] = max(accepted['oob'], options['oob'])
+    if 'snapshot' in options and accepted.get('snapshot'):
+        snapshot_socks.add(sock)
+    if 'chunk' in options and accepted.get('chunk') is not None:
+        chunk[sock] = max(accepted['chunk'], options['chunk'])
+    if 'ref' in options and accepted.get('ref'):
+        ref_socks.add(sock)
+        update_refs()
+
+
+def update_refs():
+    global ext_refs
+    ext_refs = bool(socks) and all(s in ref_socks for s in socks)
+
+
+def add_socket(sock):
+    sock.setblocking(0)
+    socks.append(sock)
+    outbox[sock] = [deque() for i in range(LANE_LOG + 1)]
+    active[sock] = []
+    backlog[sock] = 0
+    packs[sock] = new_unpacker(sock)
+    types[sock] = set()
+    rbufs[sock] = bytearray(recv_size)
+    fed[sock] = 0
+    selector.register(sock, EVENT_READ)
+    update_refs()
+
+
+def new_unpacker(s):
+    if legacy_refs and s not in ref_socks:
+        hooked.add(s)
+    else:
+        hooked.discard(s)
+    return msgpack.Unpacker(
+        object_hook = load_hook if s in hooked else None, ext_hook=ext_hook,
+        raw=False, max_buffer_size=message_max)
+
+
+def renew_unpacker(s, p, unread):
+    """
+    Replaces unpacker p of socket s by a new one fed with its unread bytes.
+    """
+    rest = p.read_bytes(unread) if unread else b''
+    p = packs[s] = new_unpacker(s)
+    p.feed(rest)
+    fed[s] = len(rest)
+    return p
+
+
 def disconnect(s):
     socks.remove(s)
+    selector.unregister(s)
+    writing.discard(s)
+    del outbox[s]
+    del active[s]
+    del backlog[s]
     del packs[s]
     del types[s]
+    del rbufs[s]
+    del fed[s]
+    hooked.discard(s)
+    compress.pop(s, None)
+    chunk.pop(s, None)
+    snapshot_socks.discard(s)
+    ref_socks.discard(s)
+    update_refs()
+    oob.pop(s, None)
+    oobs.pop(s, None)
+    s.close()
+    if s is master_sock and reconnect is not None:
+        master_lost()
+
+
+def register_fd(fileobj, callback, events=EVENT_READ):
+    """
+    Watches file object or descriptor in the application loop. The callback
+    is called from process_messages as callback(fileobj, mask) when any of
+    events is ready. Registering it again replaces callback and events.
+
+    :param fileobj: File descriptor or object with fileno() method.
+    :param callback: Function to call when file is ready.
+    :param events: Mask of selectors.EVENT_READ and selectors.EVENT_WRITE.
+    """
+    try:
+        selector.register(fileobj, events, callback)
+    except KeyError:
+        selector.modify(fileobj, events, callback)
+
+
+def unregister_fd(fileobj):
+    """
+    Stops watching file object previously registered with register_fd.
+    """
+    selector.unregister(fileobj)
+
+
+def receive(s, p):
+    buf = rbufs[s]
+    view = memoryview(buf)
+    try:
+        pending = oobs.get(s)
+        while pending and pending[2]:
+            views = pending[2]
+            size = s.recv_into(views[0])
+            if not size:
+                disconnect(s)
+                return False
+            read_stats['reads'] += 1
+            read_stats['bytes'] += size
+            if size < len(views[0]):
+                views[0] = views[0][size:]
+            else:
+                del views[0]
+        total = 0
+        while total < read_budget:
+            size = s.recv_into(buf)
+            if not size:
+                disconnect(s)
+                return False
+            read_stats['reads'] += 1
+            read_stats['bytes'] += size
+            fed[s] += size
+            total += size
+            p.feed(view[:size])
+            if size == len(buf) and size < recv_max:
+                buf = rbufs[s] = bytearray(size * 2)
+                view = memoryview(buf)
+                read_stats['buffer_max'] = max(read_stats['buffer_max'],
+                    len(buf))
+    except BlockingIOError:
+        pass
+    except OSError:
+        disconnect(s)
+        return False
+    return True
+
+
+def unpack(s, p, alive):
+    """
+    Yields (message, size) of messages received from socket s. Unpacker of
+    socket is replaced after each message with out of band buffers: its
+    position and bytes taken with read_bytes are counted differently by
+    msgpack implementations, so it is read to the end and the rest is fed to
+    a new one. fed[s] counts bytes fed to the current unpacker. It is also
+    replaced by one without object_hook once the socket accepts EXT_OBJECT.
+    """
+    while True:
+        if s in hooked and s in ref_socks and packs.get(s) is p:
+            p = renew_unpacker(s, p, fed[s] - p.tell())
+        pending = oobs.get(s) if alive else None
+        if pending:
+            message, size, views = pending
+            if views:
+                return
+            del oobs[s]
+            yield message, size
+        start = p.tell()
+        try:
+            message = next(p)
+        except StopIteration:
+            return
+        size = p.tell() - start
+        if not oob_views:
+            yield message, size
+            continue
+
+        views = oob_views[:]
+        oob_views.clear()
+        if not alive:
+            return
+        unread = fed[s] - p.tell()
+        while views and unread:
+            n = min(unread, len(views[0]))
+            views[0][:n] = p.read_bytes(n)
+            unread -= n
+            size += n
+            if n < len(views[0]):
+                views[0] = views[0][n:]
+            else:
+                del views[0]
+        p = renew_unpacker(s, p, unread)
+        oobs[s] = (message, size + sum(len(v) for v in views), views)
 
 
 def wait(stop):
@@ -303,119 +1521,354 @@ def set_socket(sock):
 
 
 def process_messages(timeout=0):
-    global reader
-    global idle
-
-    for f in wizard.get_timeouts():
-        f()
-
-    if timeout is None:
+    if run_timeouts() or pending_in:
+        # timers may have changed what the caller waits for
+        timeout = 0
+    elif timeout is None:
         timeout = wizard.get_delta()
     else:
         delta = wizard.get_delta()
         if delta is not None:
             timeout = min(timeout, delta)
 
-    rdfs, _, _ = select([reader] + socks, [], [], timeout)
-
-    if rdfs:
-        idle = 0
-    elif idle is 0:
-        idle = 1
-
-    current = []
+    events = selector.select(timeout)
+    if events:
+        activity()
+    handle_events(events)
+
+
+def run_timeouts():
+    fired = wizard.get_timeouts()
+    with set_batch(None), coalesce():
+        release_collected()
+        for f in fired:
+            f()
+    flush()
+    return fired
+
+
+def handle_events(events):
+    with set_batch(None), coalesce():
+        release_collected()
+        for key, mask in events:
+            s = key.fileobj
+            if key.data is not None:
+                key.data(s, mask)
+                continue
+            if mask & EVENT_WRITE:
+                flush_socket(s)
+            if mask & EVENT_READ and s in packs:
+                p = packs[s]
+                alive = receive(s, p)
+                if s in pending_in:
+                    alive = alive and pending_in[s][1]
+                pending_in[s] = (p, alive)
+
+        deadline = perf_counter() + tick_budget
+        while pending_in:
+            s = next(iter(pending_in))
+            p, alive = pending_in.pop(s)
+            if dispatch_messages(s, p, alive, turn_messages):
+                pending_in[s] = (packs.get(s, p), alive)
+            if perf_counter() >= deadline or wizard.get_delta() == 0:
+                # the rest waits for timers and other events
+                break
+    flush()
+
+    if master_sock is not None and master_sock not in socks:
+        if reconnect is None:
+            raise ConnectionLost()
+        master_lost()
+
+
+def dispatch_messages(s, p, alive, limit):
+    """
+    Handles up to limit received messages of socket s.
+
+    :return bool: True if socket may have more messages.
+    """
+    peer = s if alive else None
+    n = 0
+    with set_socket(peer):
+        for data, size in islice(unpack(s, p, alive), limit):
+            n += 1
+            if recorder is not None:
+                record_message(s, 'in', pack(data))
+            obj_id, method_name, call_id, *method_args = data
+            if unknown_refs:
+                reason = 'unknown object: %s' % ', '.join(
+                    map(str, unknown_refs))
+                del unknown_refs[:]
+                if obj_id is None and method_name == 'result':
+                    handle_error(*method_args[:1])
+                else:
+                    reject(call_id, reason)
+                continue
+
+            if obj_id is None:
+                method = handlers.get(method_name)
+                if method is None:
+                    reject(call_id, 'unknown method: %s' % method_name)
+                    continue
+            else:
+                entry = objects.get(obj_id)
+                obj = entry[0]() if entry is not None else None
+                if obj is None:
+                    reject(call_id, 'unknown object: %s' % obj_id)
+                    continue
+                method = find_method(obj, method_name)
+                if method is None:
+                    reject(call_id, 'unknown method: %s.%s' % (
+                        type(obj).__name__, method_name))
+                    continue
+                method_args.insert(0, obj)
 
-    for s in rdfs:
-        if s == reader:
-            try:
-                while s.recv(1024):
-                    pass
-            except BlockingIOError:
-                pass
-            for f in wizard.get_callbacks():
-                f()
-        else:
-            p = packs[s]
             try:
-                s.setblocking(0)
-                while True:
-                    buf = s.recv(4096)
-                    if not buf:
-                        disconnect(s)
-                        s = None
-                        break
-                    p.feed(buf)
-            except BlockingIOError:
-                s.setblocking(1)
-
-            current.append((s, p))
-
-    for s, p in current:
-        with set_socket(s):
-            for data in p:
-                obj_id, method_name, call_id, *method_args = data
-
-                if obj_id is None:
-                    method = globals()['handle_' + data[1]]
-                else:
-                    if obj_id not in objects:
-                        #send error
-                        pass
+                if stats_enabled:
+                    started = perf_counter()
                     try:
-                        method = getattr(objects[obj_id][0], method_name)
-                    except:
-                        traceback.print_exc()
-                        err = traceback.format_exc()
-                        call(None, 'error', call_id, err)
-                        continue
-
-                try:
+                        result = method(*method_args)
+                    finally:
+                        record_inbound(obj_id, method_args,
+                            method_name, size,
+                            perf_counter() - started)
+                else:
                     result = method(*method_args)
-                    if call_id is not None:
-                        call(None, 'result', call_id, result)
-                except:
-                    traceback.print_exc()
-                    err = traceback.format_exc()
-                    call(None, 'error', call_id, err)
+                if defer is not None and inspect.isawaitable(result):
+                    defer(result, s, call_id)
+                elif call_id is not None:
+                    call(None, 'result', call_id, result)
+            except:
+                traceback.print_exc()
+                err = traceback.format_exc()
+                call(None, 'error', call_id, err)
+    return n == limit
+
+
+def enable_reconnect(connect_args):
+    """
+    Keeps application running when master connection is lost and connects
+    again with connect_args, see connect.
+    """
+    global reconnect
+    reconnect = tuple(connect_args)
+
+
+def queue_offline(message):
+    global offline_size
+    global offline_dropped
+    offline.append(message)
+    offline_size += len(message)
+    while offline_size > offline_max:
+        offline_size -= len(offline.popleft())
+        offline_dropped += 1
+
+
+def master_lost():
+    global master_sock
+    global reconnect_since
+    global reconnect_wait
+    global offline_size
+
+    master_sock = None
+    reconnect_since = monotonic()
+    reconnect_wait = reconnect_delay
+    # calls without results go first, DICE may have missed them
+    waiting = [f.message for f in sorted(calls.values(),
+        key=lambda f: f.call_id) if f.message is not None]
+    offline.extendleft(reversed(waiting))
+    offline_size += sum(len(v) for v in waiting)
+    wizard.timeout(try_reconnect, reconnect_wait)
+
+
+def try_reconnect():
+    global reconnect_wait
+    global offline_size
+    global offline_dropped
+
+    try:
+        connect(*reconnect)
+    except OSError:
+        if monotonic() - reconnect_since >= reconnect_give_up:
+            raise ConnectionLost()
+        reconnect_wait = min(reconnect_wait * 2, reconnect_delay_max)
+        wizard.timeout(try_reconnect, reconnect_wait)
+        return
+
+    with coalesce():
+        while offline and master_sock is not None:
+            send(offline.popleft(), 3)
+        offline_size = 0
+        if offline_dropped:
+            call(None, 'stderr', '[%i messages dropped while disconnected]'
+                % offline_dropped, mode=3)
+            offline_dropped = 0
+
+
+def record_inbound(obj_id, args, method_name, size, elapsed):
+    if obj_id is not None:
+        target = type(args[0]).__name__ + '.' + method_name
+    else:
+        target = method_name
+    entry = in_stats.get(target)
+    if entry is None:
+        entry = in_stats[target] = [0, 0, Histogram()]
+    entry[0] += 1
+    entry[1] += size
+    entry[2].add(elapsed)
+
+
+def enable_stats(enabled=True, path=None):
+    """
+    Turns RPC instrumentation on or off.
+
+    :param path: File to write stats as JSON to on shutdown.
+    """
+    global stats_enabled
+    global stats_path
+    stats_enabled = enabled
+    if path is not None:
+        stats_path = path
+
+
+def stats(reset=False):
+    """
+    Returns collected RPC stats. Durations are in seconds.
+
+    :param reset: Clears stats after they are returned.
+    :return dict: Outbound calls by method name with counts and encoded
+        bytes, inbound calls by target with counts, bytes and handler time,
+        round trip latency of awaited calls by method name, and bytes sent
+        raw and before and after lz4 compression, and reads of sockets.
+    """
+    result = {
+        'outbound': {k: {'count': v[0], 'bytes': v[1]}
+            for k, v in out_stats.items()},
+        'inbound': {k: {'count': v[0], 'bytes': v[1], 'time': v[2].summary()}
+            for k, v in in_stats.items()},
+        'round_trip': {k: v.summary() for k, v in rtt_stats.items()},
+        'lz4': dict(lz4_bytes),
+        'read': dict(read_stats)
+        }
+    if reset:
+        out_stats.clear()
+        in_stats.clear()
+        rtt_stats.clear()
+        lz4_bytes.update(dict.fromkeys(lz4_bytes, 0))
+        read_stats.update(reads=0, bytes=0)
+    return result
+
+
+def dump_stats(path=None):
+    path = path or stats_path
+    if path:
+        with open(path, 'w') as f:
+            json.dump(stats(), f, indent=2, sort_keys=True)
+
+
+def record(path, header=None):
+    """
+    Records all messages sent and received from now on to a file which
+    dice_tools.replay can play back. Use --dice-record to record a whole
+    session, replay needs objects to be created after recording starts.
+
+    :param header: Additional values to store in file header.
+    """
+    global recorder
+    global record_start
+    stop_recording()
+    recorder = open(path, 'wb')
+    record_start = perf_counter()
+    record_socks.clear()
+    header = dict(header or (), version=1, time=time())
+    recorder.write(msgpack.packb(header, use_bin_type=True))
+
+
+def stop_recording():
+    global recorder
+    if recorder is not None:
+        recorder.close()
+        recorder = None
 
-    if current and master_sock not in socks:
-        raise ConnectionLost()
+
+def record_message(s, direction, message, buffers=None):
+    n = record_socks.get(s)
+    if n is None:
+        n = record_socks[s] = len(record_socks)
+    if buffers:
+        message = b''.join([message] + buffers)
+    recorder.write(msgpack.packb(
+        (perf_counter() - record_start, n, direction, message),
+        use_bin_type=True))
+
+
+def reject(call_id, reason):
+    if call_id is not None:
+        call(None, 'error', call_id, reason)
 
 
 class ConnectionLost(Exception):
     pass
 
 
-idle = 0
+# w_idle is sent once after events stopped for idle_quiet seconds. The timer
+# runs only while there are events and is moved forward lazily when it fires
+# early, an idle application has no wakeups at all.
+idle_quiet = 0.1
+idle_since = None
+idle_timer = None
 
+# Handlers may return awaitables when an event loop sets this to a function
+# which runs them and replies when they finish, see dice_tools.aio.
+defer = None
 
-def idle_func():
-    global idle
-    if idle == 1:
-        idle = 2
-    elif idle == 2:
-        idle = -1
-        wizard.w_idle()
 
+def activity():
+    global idle_since
+    global idle_timer
+    idle_since = monotonic()
+    if idle_timer is None:
+        idle_timer = wizard.timeout(idle_func, idle_quiet)
 
-def run():
-    global app, reader
-    global current_socket
 
+def idle_func():
+    global idle_timer
+    delta = idle_since + idle_quiet - monotonic()
+    if delta > 0:
+        idle_timer.reschedule(delta)
+    else:
+        idle_timer = None
+        wizard.w_idle()
 
 
-    reader, writer = socket.socketpair()
-    reader.setblocking(0)
-    writer.setblocking(0)
+def read_wake(s, mask):
+    try:
+        while s.recv(1024):
+            pass
+    except BlockingIOError:
+        pass
+    send_posted()
+    for f in wizard.get_callbacks():
+        f()
 
-    def wake():
-        writer.send(b'\x00')
 
-    wizard.setup(wake)
+def start(wake, schedule=None, argv=None):
+    global app
+
+    wizard.setup(wake, schedule)
 
     from ._types import Application
 
-    args, _ = parser.parse_known_args()
+    args, _ = parser.parse_known_args(argv)
+
+    if args.dice_stats:
+        enable_stats(path=args.dice_stats)
+    if args.dice_record:
+        record(args.dice_record, {
+            'instance_id': args.dice_instance_id,
+            'workflow_dir': args.dice_workflow_dir,
+            'progress': args.dice_progress
+            })
 
     app = Application.__subclasses__()[0](
         instance_id=args.dice_instance_id,
@@ -423,12 +1876,33 @@ def run():
         progress=args.dice_progress
     )
 
-    connect(args.dice_addr, args.dice_port)
+    connect_args = (args.dice_addr, args.dice_port, args.dice_compress,
+        args.dice_oob, args.dice_snapshot, args.dice_refs, args.dice_chunk)
+    connect(*connect_args)
+    if args.dice_reconnect:
+        enable_reconnect(connect_args)
 
     sys.stdout.write = stdout_write
     sys.stderr.write = stderr_write
 
-    timeout = wizard.timeout(idle_func, 0.1, -1)
+    activity()
+
+
+def run(argv=None):
+    global reader
+    global current_socket
+
+
+
+    reader, writer = socket.socketpair()
+    reader.setblocking(0)
+    writer.setblocking(0)
+    register_fd(reader, read_wake)
+
+    def wake():
+        writer.send(b'\x00')
+
+    start(wake, argv=argv)
 
     try:
         while True:
@@ -437,4 +1911,7 @@ def run():
         pass
     finally:
         wizard.w_idle()
+        flush_output()
         wizard.w_shutdown()
+        dump_stats()
+        stop_recording()
@@ -13,7 +13,9 @@ import pprint
 
 # DICE modules
 # ============
-from ._client import call, call_ex, instantiate, delete, app_log, socks
+from ._client import (call, call_ex, instantiate, delete, app_log, socks,
+    flush, set_property)
+from . import _client
 from ._wizard import wizard
 
 __all__ = [
@@ -156,7 +158,7 @@ class diceProperty(property):
             self.__fset(obj, value)
             new_value = self.__fget(obj)
             if old_value != new_value:
-                call(obj, '__dice_set_property__', self.__attr_name, new_value)
+                set_property(obj, self.__attr_name, new_value)
 
     def _send(self, obj):
         call(obj,
@@ -297,6 +299,9 @@ class DICEObject(object, metaclass = DICEObjectMeta):
         pass
 
     def connected(self):
+        if _client.in_snapshot:
+            # property values went with the snapshot
+            return
         for info in self.__dice_properties__:
             getattr(self.__class__, info['attr_name'])._send(self)
 
@@ -432,11 +437,38 @@ class Application(DICEObject, metaclass=ApplicationMeta):
     def run(self, start, count):
         """
         Does all the calculations application designed for. Need to be
-        implemented in application.
+        implemented in application. Tasks may be coroutines when application
+        runs with dice_tools.aio, run returns coroutine then.
 
         :return bool: True on successful calculations.
         """
+        steps = self.__run_tasks(start, count)
+        if any(inspect.iscoroutinefunction(m) for m in self.__dice_tasks__):
+            return self.__run_async(steps)
+        res = None
+        try:
+            while True:
+                res = steps.send(res)
+        except StopIteration as e:
+            return e.value
+
+    async def __run_async(self, steps):
+        try:
+            res = steps.send(None)
+            while True:
+                if inspect.isawaitable(res):
+                    try:
+                        value = await res
+                    except BaseException as e:
+                        res = steps.throw(e)
+                        continue
+                else:
+                    value = res
+                res = steps.send(value)
+        except StopIteration as e:
+            return e.value
 
+    def __run_tasks(self, start, count):
         self.__set_runnning(True)
         try:
             wizard.w_idle()
@@ -460,8 +492,9 @@ class Application(DICEObject, metaclass=ApplicationMeta):
                 with app_log(meth.__dicetask__['name']):
                     if meth.__dicetask__['desc']:
                         self.log(meth.__dicetask__['desc'])
+                    flush()
                     try:
-                        res = meth(self)
+                        res = yield meth(self)
                         if not res:
                             return False
                     except:
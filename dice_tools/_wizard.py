@@ -3,8 +3,9 @@ import _thread
 from types import MethodType, FunctionType
 from inspect import signature
 from weakref import ref, WeakKeyDictionary, WeakSet, WeakMethod
-from heapq import heappush, heappop
-from time import time
+from heapq import heappush, heappop, heapify
+from time import monotonic
+from itertools import count
 from collections import Counter
 from queue import Queue, Empty
 
@@ -15,27 +16,55 @@ __all__ = ['wizard']
 class _Wizard:
     
     class _Timeout:
+        """
+        Timer in wizard.timeouts heap as (ts, seq, timeout) entry. Entry is
+        current while its seq matches timeout.seq, others are left in heap
+        and skipped, seq is None while timeout is not scheduled.
+        """
 
-        __slots__ = 'sub', 'delay', 'repeats', 'ts'
+        __slots__ = 'sub', 'delay', 'repeats', 'ts', 'seq'
 
         def __init__(self, sub, delay, repeats):
             self.sub = ref(sub, self.remove)
             self.delay = delay
             self.repeats = repeats
-            self.reset()
-
-        def reset(self):
-            self.ts = self.delay + time()
+            self.seq = None
+            self.reschedule()
+
+        def reschedule(self, delay=None):
+            """
+            Moves timeout to fire delay seconds from now, by default its own
+            delay. Removed or fired timeouts are scheduled again.
+            """
+            if delay is not None:
+                self.delay = delay
+            if self.repeats == 0:
+                self.repeats = 1
+            if self.seq is not None:
+                wizard.drop_entry()
+            self.ts = self.delay + monotonic()
+            self.seq = next(wizard.seqs)
+            heappush(wizard.timeouts, (self.ts, self.seq, self))
+            if wizard.timeouts[0][2] is self:
+                wizard.schedule()
 
         def remove(self, *args):
             self.repeats = 0
-            for i, v in enumerate(wizard.timeouts):
-                if v[1] == self:
-                    del wizard.timeouts[i]
-                    return
-
-        def __lt__(self, other):
-            return self.ts < other.ts
+            if self.seq is not None:
+                self.seq = None
+                wizard.drop_entry()
+
+        def __call__(self):
+            if self.repeats == 0 or self.seq is not None:
+                # removed or rescheduled after it was due
+                return
+            self.repeats -= 1
+            sub = self.sub()
+            sub = sub() if sub is not None else None
+            if sub:
+                sub()
+            if self.repeats != 0 and self.seq is None:
+                self.reschedule()
 
     class _Subscriber(ref):
 
@@ -53,44 +82,63 @@ class _Wizard:
         self.refs = WeakKeyDictionary()
         self.objs = {}
         self.methods = {}
+        self.compiled = set()
 
         self.timeouts = []
+        self.seqs = count()
+        self.stale = 0
         self.callbacks = Queue()
         self.thread_ident = None
         self.wake = lambda: None
+        self.schedule = lambda: None
 
-    def setup(self, wake):
+    def setup(self, wake, schedule=None):
         self.wake = wake
+        if schedule is not None:
+            self.schedule = schedule
         self.thread_ident = _thread.get_ident()
+        self.invalidate()
         self.wake()
 
+    def first(self):
+        timeouts = self.timeouts
+        while timeouts:
+            ts, seq, timeout = timeouts[0]
+            if timeout.seq == seq:
+                return ts
+            heappop(timeouts)
+            self.stale -= 1
+        return None
+
     def get_delta(self):
-        if self.timeouts:
-            return max(0, self.timeouts[0][0] - time())
+        ts = self.first()
+        if ts is not None:
+            return max(0, ts - monotonic())
         return None
 
     def get_timeouts(self):
+        """
+        Takes timeouts which are due.
+
+        :return list: Timeouts to call in order.
+        """
         result = []
-        while self.timeouts:
-            ts, timeout = self.timeouts[0]
-            delta = ts - time()
-            if delta <= 0:
-                self.timeouts.pop(0)
-                if timeout.ts == ts:
-                    def f(timeout=timeout):
-                        timeout.repeats -= 1
-                        sub = timeout.sub()()
-                        if sub:
-                            sub()
-                        if timeout.repeats != 0:
-                            timeout.reset()
-                            heappush(self.timeouts, (timeout.ts, timeout))
-                    result.append(f)
-                else:
-                    heappush(self.timeouts, (timeout.ts, timeout))
-            else:
-                break
-        return result
+        now = monotonic()
+        while True:
+            ts = self.first()
+            if ts is None or ts > now:
+                return result
+            timeout = heappop(self.timeouts)[2]
+            timeout.seq = None
+            result.append(timeout)
+
+    def drop_entry(self):
+        self.stale += 1
+        if self.stale > 64 and self.stale * 2 > len(self.timeouts):
+            # most of heap is stale, keep current entries only
+            self.timeouts[:] = [v for v in self.timeouts if v[2].seq == v[1]]
+            heapify(self.timeouts)
+            self.stale = 0
 
     def get_callbacks(self):
         result = []
@@ -99,7 +147,7 @@ class _Wizard:
                 method, args, kwargs = self.callbacks.get(False)
 
                 def f(method=method, args=args, kwargs=kwargs):
-                    self.__getattr__(method)(*args, **kwargs)
+                    getattr(self, method)(*args, **kwargs)
                 result.append(f)
         except Empty:
             return result
@@ -117,9 +165,7 @@ class _Wizard:
 
         subscriber = self.subs.setdefault(parent, dict()).setdefault(
             subscriber, subscriber)
-        timeout = _Wizard._Timeout(subscriber, delay, repeats)
-        heappush(self.timeouts, (timeout.ts, timeout))
-        return timeout
+        return _Wizard._Timeout(subscriber, delay, repeats)
 
     def remove_timeout(self, timeout):
         timeout.remove()
@@ -127,6 +173,7 @@ class _Wizard:
     _undefined = object()
 
     def subscribe(self, *args, **kwargs):
+        self.invalidate()
         subscriber, *args = args
         if type(subscriber) == str or subscriber is None:
             method = subscriber
@@ -185,6 +232,7 @@ class _Wizard:
             objs.setdefault(item, WeakSet()).add(subscriber)
 
     def unsubscribe(self, *args, **kwargs):
+        self.invalidate()
         subscriber, *args = args
         if type(subscriber) == str or subscriber is None:
             method = subscriber
@@ -248,42 +296,72 @@ class _Wizard:
                     subs.discard(subscriber)
 
     def __getattr__(self, method):
-        
+
         assert self.thread_ident is not None
 
         if self.thread_ident != _thread.get_ident():
+            # only the loop thread compiles and caches, see invalidate()
             def f(*args, **kwargs):
                 self.callbacks.put((method, args, kwargs))
                 self.wake()
             return f
 
-        def f(*args, **kwargs):
-
-            if method in self.methods:
-                method_data = self.methods[method]
-                subs = list(method_data[0])
-            else:
-                method_data = None
-                subs = []
+        f = self.compile(method)
+        # found as plain attribute from now on, until invalidate()
+        self.__dict__[method] = f
+        self.compiled.add(method)
+        return f
 
-            def collect(v, refs, objs):
-                nonlocal subs
-                try:
-                    subs += list(objs.get(v, ()))
-                    subs += list(refs.get(v, ()))
-                except TypeError:
-                    pass
+    def invalidate(self):
+        """
+        Drops dispatchers compiled for current subscriptions.
+        """
+        for method in self.compiled:
+            self.__dict__.pop(method, None)
+        self.compiled.clear()
 
-            for i, v in enumerate(args):
-                if method_data:
-                    collect(v, method_data[1], method_data[2])
-                    if i in method_data[3]:
-                        refs, objs = method_data[3][i]
-                        collect(v, refs, objs)
-                collect(v, self.refs, self.objs)
+    def compile(self, method):
+        """
+        Returns function which calls subscribers of method. Subscribers of
+        method itself are collected once, subscribers of arguments are
+        looked up only in tables which have any.
+        """
+        method_data = self.methods.get(method)
+        subs = list(method_data[0]) if method_data else []
+        tables = []
+        if method_data:
+            if method_data[1] or method_data[2]:
+                tables.append((None, method_data[2], method_data[1]))
+            for i, (refs, objs) in method_data[3].items():
+                tables.append((i, objs, refs))
+        if self.refs or self.objs:
+            tables.append((None, self.objs, self.refs))
 
-            for s in subs:
-                v = getattr(s(), method, s())
+        def f(*args, **kwargs):
+            if self.thread_ident != _thread.get_ident():
+                self.callbacks.put((method, args, kwargs))
+                self.wake()
+                return
+
+            found = subs
+            if tables and args:
+                found = list(subs)
+                for i, v in enumerate(args):
+                    for key, objs, refs in tables:
+                        if key is None or key == i:
+                            try:
+                                found += objs.get(v, ())
+                                found += refs.get(v, ())
+                            except TypeError:
+                                pass
+
+            for s in found:
+                o = s()
+                if o is None:
+                    # subscriber is gone, collect subscribers again next time
+                    self.invalidate()
+                    continue
+                v = getattr(o, method, o)
                 if callable(v):
                     v(*args, **kwargs)
 
@@ -0,0 +1,220 @@
+"""
+Runs DICE application on asyncio event loop. Sockets, wizard callbacks from
+other threads and wizard timeouts are served by the loop, so application
+can await DICE calls together with any other asyncio based I/O::
+
+    from dice_tools import aio
+
+    class App(Application):
+
+        @diceTask('Prepare')
+        async def prepare(self):
+            settings = await aio.app_settings()
+            ...
+            return True
+
+    aio.run()
+
+Blocking calls like call_ex still work in this mode, but they block the
+event loop until their result arrives. Requires selector based event loop,
+i.e. it does not work with proactor loop on Windows.
+"""
+import asyncio
+import selectors
+import traceback
+
+from functools import partial
+from . import _client
+from ._client import (call, call_async, coalesce, flush, set_socket,
+    set_batch, handle_events, run_timeouts, ConnectionLost)
+from ._wizard import wizard
+
+__all__ = [
+    'run',
+    'call_ex',
+    'app_settings',
+    'browse_rdl'
+    ]
+
+
+class LoopSelector(selectors.DefaultSelector):
+    """
+    Selector which also watches its files in asyncio event loop and handles
+    their events as soon as the loop reports them. The selector itself is
+    still used by process_messages for nested blocking waits.
+    """
+
+    def __init__(self, loop, lost):
+        super().__init__()
+        self.loop = loop
+        self.lost = lost
+        self.resuming = False
+
+    def register(self, fileobj, events, data=None):
+        key = super().register(fileobj, events, data)
+        self.watch(key)
+        return key
+
+    def unregister(self, fileobj):
+        key = super().unregister(fileobj)
+        self.loop.remove_reader(key.fd)
+        self.loop.remove_writer(key.fd)
+        return key
+
+    def modify(self, fileobj, events, data=None):
+        key = super().modify(fileobj, events, data)
+        self.watch(key)
+        return key
+
+    def watch(self, key):
+        if key.events & selectors.EVENT_READ:
+            self.loop.add_reader(key.fd, self.ready, key.fileobj,
+                selectors.EVENT_READ)
+        else:
+            self.loop.remove_reader(key.fd)
+        if key.events & selectors.EVENT_WRITE:
+            self.loop.add_writer(key.fd, self.ready, key.fileobj,
+                selectors.EVENT_WRITE)
+        else:
+            self.loop.remove_writer(key.fd)
+
+    def ready(self, fileobj, mask):
+        _client.activity()
+        try:
+            key = self.get_key(fileobj)
+        except KeyError:
+            return
+        self.guard(handle_events, [(key, mask)])
+
+    def resume(self):
+        self.resuming = False
+        self.guard(handle_events, [])
+
+    def guard(self, f, *args):
+        try:
+            f(*args)
+        except ConnectionLost:
+            if not self.lost.done():
+                self.lost.set_result(None)
+        if _client.pending_in and not self.resuming:
+            # messages left over by the time budget, after other callbacks
+            self.resuming = True
+            self.loop.call_soon(self.resume)
+        schedule()
+
+
+timer = None
+
+
+def schedule():
+    global timer
+    if timer is not None:
+        timer.cancel()
+        timer = None
+    delta = wizard.get_delta()
+    if delta is not None:
+        timer = asyncio.get_event_loop().call_later(delta, on_timeouts)
+
+
+def on_timeouts():
+    global timer
+    timer = None
+    _client.selector.guard(run_timeouts)
+
+
+def on_callbacks():
+    _client.send_posted()
+    with set_batch(None), coalesce():
+        for f in wizard.get_callbacks():
+            f()
+
+
+def defer(awaitable, sock, call_id):
+    task = asyncio.ensure_future(awaitable)
+    task.add_done_callback(partial(reply, sock, call_id))
+
+
+def reply(sock, call_id, task):
+    if task.cancelled():
+        return
+    with set_socket(sock):
+        try:
+            result = task.result()
+            if call_id is not None:
+                call(None, 'result', call_id, result)
+        except Exception:
+            traceback.print_exc()
+            call(None, 'error', call_id, traceback.format_exc())
+    _client.selector.guard(flush)
+
+
+def wrap(future):
+    result = asyncio.get_event_loop().create_future()
+
+    def done(f):
+        if result.done():
+            return
+        if f.cancelled():
+            result.cancel()
+        elif f.exception() is not None:
+            result.set_exception(f.exception())
+        else:
+            result.set_result(f.result())
+
+    def cancelled(r):
+        if r.cancelled():
+            future.cancel()
+
+    future.add_done_callback(done)
+    result.add_done_callback(cancelled)
+    return result
+
+
+async def call_ex(obj, name, *args, timeout=None):
+    """
+    Awaitable version of dice_tools.call_ex. Cancelling the await cancels
+    the call.
+    """
+    return await wrap(call_async(obj, name, *args, timeout=timeout))
+
+
+async def app_settings():
+    return await call_ex(None, 'app_settings')
+
+
+async def browse_rdl(templates, entities):
+    return await call_ex(None, 'browse_rdl', templates, entities)
+
+
+async def main():
+    loop = asyncio.get_event_loop()
+    lost = loop.create_future()
+    _client.selector = LoopSelector(loop, lost)
+    _client.defer = defer
+
+    def wake():
+        loop.call_soon_threadsafe(_client.selector.guard, on_callbacks)
+
+    _client.start(wake, schedule)
+    schedule()
+
+    try:
+        await lost
+    finally:
+        wizard.w_idle()
+        _client.flush_output()
+        wizard.w_shutdown()
+        _client.dump_stats()
+        _client.stop_recording()
+
+
+def run():
+    """
+    Asyncio version of dice_tools.run.
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(main())
+    finally:
+        loop.close()
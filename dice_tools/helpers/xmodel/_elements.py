@@ -1,5 +1,5 @@
 from dice_tools import wizard
-from collections import MutableSequence
+from collections.abc import MutableSequence
 
 __all__ = [
     'ModelElements'
@@ -1,4 +1,4 @@
-from collections import MutableSet
+from collections.abc import MutableSet
 from dice_tools import wizard
 from weakref import WeakSet
 
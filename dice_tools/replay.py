@@ -0,0 +1,266 @@
+"""
+Plays back sessions recorded with --dice-record or dice_tools.record()
+without DICE. Replayer acts as the master: it serves the application over
+loopback and sends recorded inbound messages of the master connection to it
+at recorded speed or as fast as possible::
+
+    from dice_tools import replay
+
+    class App(Application):
+        ...
+
+    replayer = replay.run('session.rec', speed=None)
+    print(replayer.elapsed)
+
+Objects and calls of the running application get other ids than they had
+in the recorded session. Replayer maps them in order of creation per type
+name and in order of sending per method name, so the application has to
+create objects and make calls the same way it did when recorded. Inbound
+messages which can't be mapped are skipped and counted.
+"""
+import socket
+import threading
+import msgpack
+
+from select import select
+from time import perf_counter
+from collections import deque
+from . import _client
+
+__all__ = [
+    'run',
+    'read_session',
+    'Replayer'
+    ]
+
+
+def read_session(path):
+    """
+    Reads recorded session.
+
+    :return tuple: Header and list of (seconds, socket number, direction,
+        message) records.
+    """
+    with open(path, 'rb') as f:
+        unpacker = msgpack.Unpacker(f, raw=False,
+            max_buffer_size=_client.message_max)
+        header = next(unpacker)
+        return header, [tuple(v) for v in unpacker]
+
+
+class Replayer(threading.Thread):
+    """
+    Stand-in master which replays inbound messages of recorded session to
+    one application connection.
+
+    :param speed: Playback speed relative to recording, None plays back as
+        fast as application handles messages.
+    :param patience: Seconds to wait for application to create object or
+        send call referenced by next message before the message is skipped.
+    :param linger: Seconds of application silence to wait for after last
+        message before connection is closed.
+    """
+
+    def __init__(self, path, speed=1.0, patience=5.0, linger=0.5):
+        super().__init__(daemon=True)
+        self.header, self.records = read_session(path)
+        self.speed = speed
+        self.patience = patience
+        self.linger = linger
+        self.sent = 0
+        self.skipped = 0
+        self.elapsed = None
+        self.error = None
+
+        self.objects = {}
+        self.calls = {}
+        self.dropped = set()
+        self.recorded_new = {}
+        self.recorded_calls = {}
+        self.live_new = {}
+        self.live_calls = {}
+
+        self.server = socket.socket()
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(1)
+        self.address = self.server.getsockname()
+
+    def argv(self, workflow_dir=None):
+        """
+        Returns command line arguments which connect application to this
+        replayer.
+        """
+        return [
+            '--dice-addr', self.address[0],
+            '--dice-port', str(self.address[1]),
+            '--dice-progress', str(self.header.get('progress', 0)),
+            '--dice-instance-id', self.header.get('instance_id', ''),
+            '--dice-workflow-dir',
+                workflow_dir or self.header.get('workflow_dir', '.')
+            ]
+
+    def run(self):
+        try:
+            self.conn, _ = self.server.accept()
+            self.server.close()
+            self.conn.setblocking(0)
+            self.handshake = True
+            self.unpacker = msgpack.Unpacker(raw=False,
+                max_buffer_size=_client.message_max)
+            self.replay()
+        except Exception as e:
+            self.error = e
+            raise
+        finally:
+            self.conn.close()
+
+    def replay(self):
+        start = perf_counter()
+        for ts, n, direction, message in self.records:
+            if n != 0:
+                continue
+            message = msgpack.unpackb(message, raw=False,
+                max_bin_len=_client.message_max)
+            if direction == 'out':
+                self.expect(message)
+                continue
+            if self.speed is not None:
+                self.poll(start + ts / self.speed)
+            message = self.remap(message)
+            if message is None:
+                continue
+            self.write(msgpack.packb(message, use_bin_type=True))
+            self.sent += 1
+        self.elapsed = perf_counter() - start
+        while self.poll(perf_counter() + self.linger):
+            pass
+
+    def expect(self, message):
+        obj_id, name, call_id, *args = message
+        if name == 'new' and obj_id is None:
+            self.match(self.recorded_new, self.live_new, self.objects,
+                args[2], args[0])
+        if name == 'snapshot' and obj_id is None:
+            for obj, type_id, type_name in args[0]['objects']:
+                self.match(self.recorded_new, self.live_new, self.objects,
+                    type_name, obj)
+        if call_id is not None:
+            if name == 'wire':
+                # replayed application doesn't negotiate wire options
+                self.dropped.add(call_id)
+            else:
+                self.match(self.recorded_calls, self.live_calls, self.calls,
+                    name, call_id)
+
+    def remap(self, message):
+        deadline = perf_counter() + self.patience
+        while True:
+            try:
+                return self.translate(message)
+            except KeyError:
+                if self.dropped.intersection(message[3:4]):
+                    return None
+                if not self.receive(deadline - perf_counter()):
+                    self.skipped += 1
+                    return None
+
+    def translate(self, message):
+        obj_id, name, call_id, *args = message
+        if obj_id is not None:
+            obj_id = self.objects[obj_id]
+        if obj_id is None and name in ('result', 'error'):
+            args[0] = self.calls[args[0]]
+        return [obj_id, name, call_id] + [self.translate_value(v)
+            for v in args]
+
+    def translate_value(self, value):
+        if isinstance(value, dict):
+            if '__object__' in value:
+                return {'__object__': self.objects[value['__object__']]}
+            return {k: self.translate_value(v) for k, v in value.items()}
+        if isinstance(value, msgpack.ExtType) and (
+                value.code == _client.EXT_OBJECT):
+            handle = self.objects[int.from_bytes(value.data, 'big')]
+            return msgpack.ExtType(_client.EXT_OBJECT,
+                handle.to_bytes((handle.bit_length() + 7) // 8, 'big'))
+        if isinstance(value, list):
+            return [self.translate_value(v) for v in value]
+        return value
+
+    def poll(self, deadline):
+        """
+        Reads application messages until deadline.
+
+        :return bool: False if application sent nothing.
+        """
+        got = False
+        while self.receive(deadline - perf_counter()):
+            got = True
+        return got
+
+    def receive(self, timeout):
+        r, _, _ = select([self.conn], [], [], max(timeout, 0))
+        return bool(r) and self.read()
+
+    def read(self):
+        try:
+            data = self.conn.recv(1 << 16)
+        except BlockingIOError:
+            return False
+        if not data:
+            raise ConnectionError('application closed connection')
+        if self.handshake:
+            if b'\x00' not in data:
+                return True
+            data = data[data.index(b'\x00') + 1:]
+            self.handshake = False
+        self.unpacker.feed(data)
+        for obj_id, name, call_id, *args in self.unpacker:
+            if name == 'new' and obj_id is None:
+                self.match(self.live_new, self.recorded_new, self.objects,
+                    args[2], args[0], live=True)
+            if call_id is not None:
+                self.match(self.live_calls, self.recorded_calls, self.calls,
+                    name, call_id, live=True)
+        return True
+
+    def match(self, queues, others, ids, key, value, live=False):
+        """
+        Pairs recorded and live ids of the same key in order they appear.
+        """
+        other = others.get(key)
+        if other:
+            if live:
+                ids[other.popleft()] = value
+            else:
+                ids[value] = other.popleft()
+        else:
+            queues.setdefault(key, deque()).append(value)
+
+    def write(self, data):
+        view = memoryview(data)
+        while view:
+            r, w, _ = select([self.conn], [self.conn], [])
+            if r:
+                self.read()
+            if w:
+                try:
+                    view = view[self.conn.send(view):]
+                except BlockingIOError:
+                    pass
+
+
+def run(path, speed=1.0, workflow_dir=None, **kwargs):
+    """
+    Replays recorded session to application defined in the calling module,
+    like dice_tools.run does with DICE.
+
+    :param speed: Playback speed, None plays back as fast as possible.
+    :param workflow_dir: Overrides workflow directory of recorded session.
+    :return Replayer: Finished replayer with playback counters and timing.
+    """
+    replayer = Replayer(path, speed, **kwargs)
+    replayer.start()
+    _client.run(replayer.argv(workflow_dir))
+    replayer.join()
+    return replayer
@@ -0,0 +1,67 @@
+"""
+Application served on asyncio event loop by dice_tools.aio, started by
+test_client in a subprocess.
+"""
+import asyncio
+
+from dice_tools import (Application, diceProperty, diceTask, call_ex, wizard,
+    aio, _client)
+
+
+class AioApp(Application):
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.__value = 0
+        self.timer_done = None
+
+    @diceProperty(int)
+    def value(self):
+        return self.__value
+
+    @value.setter
+    def value(self, value):
+        self.__value = value
+
+    def ping(self):
+        return True
+
+    def blocking(self, value):
+        return call_ex(None, 'echo', value)
+
+    async def echo_all(self, n):
+        return await asyncio.gather(
+            *[aio.call_ex(None, 'echo', i) for i in range(n)])
+
+    async def wait_timer(self, delay):
+        self.timer_done = asyncio.get_event_loop().create_future()
+        start = asyncio.get_event_loop().time()
+        wizard.timeout(self.on_timer, delay)
+        await self.timer_done
+        return asyncio.get_event_loop().time() - start
+
+    def on_timer(self):
+        self.timer_done.set_result(None)
+
+    async def cancel_slow(self, timeout, wait):
+        try:
+            await asyncio.wait_for(aio.call_ex(None, 'slow'), timeout)
+        except asyncio.TimeoutError:
+            pass
+        else:
+            return 'replied'
+        pending = len(_client.calls)
+        # the late reply arrives meanwhile and is dropped
+        await asyncio.sleep(wait)
+        return pending, len(_client.calls)
+
+    @diceTask('Prepare')
+    async def prepare(self):
+        settings = await aio.app_settings()
+        await asyncio.sleep(0.01)
+        self.value = settings['value']
+        return True
+
+
+if __name__ == '__main__':
+    aio.run()
@@ -0,0 +1,140 @@
+"""
+Loopback benchmarks for the client write path. Run with:
+
+    python -m dice_tools.tests.bench_client
+"""
+import socket
+import threading
+import msgpack
+
+from time import perf_counter
+from select import select
+from dice_tools import _client, call, batch
+
+
+class Sink(threading.Thread):
+    """
+    Stand-in master which accepts one connection and drains it until the
+    client shuts the connection down.
+    """
+
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.received = 0
+        self.done = threading.Event()
+        self.server = socket.socket()
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(1)
+        self.address = self.server.getsockname()
+
+    def run(self):
+        conn, _ = self.server.accept()
+        buf = bytearray(1 << 16)
+        while True:
+            size = conn.recv_into(buf)
+            if not size:
+                break
+            self.received += size
+        self.done.set()
+        conn.close()
+        self.server.close()
+
+
+def attach(address):
+    sock = socket.create_connection(address)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    _client.add_socket(sock)
+    return sock
+
+
+def drain(sock):
+    while _client.backlog[sock]:
+        select([], [sock], [])
+        _client.flush_socket(sock)
+
+
+def bench_calls(count, coalesce):
+    sink = Sink()
+    sink.start()
+    sock = attach(sink.address)
+    try:
+        start = perf_counter()
+        if coalesce:
+            with batch():
+                for i in range(count):
+                    call(None, 'notify', {'message': 'progress', 'value': i})
+        else:
+            for i in range(count):
+                call(None, 'notify', {'message': 'progress', 'value': i})
+        drain(sock)
+        sock.shutdown(socket.SHUT_WR)
+        sink.done.wait()
+        return count / (perf_counter() - start)
+    finally:
+        _client.disconnect(sock)
+
+
+class Item:
+    pass
+
+
+def object_message(items):
+    """
+    Message like model updates send: object references in plain maps.
+    """
+    return (None, 'update', None, [
+        {'item': v, 'parent': items[0], 'name': 'item', 'value': i}
+        for i, v in enumerate(items)])
+
+
+def bench_encode(count, items, ext):
+    _client.ext_refs = ext
+    message = object_message(items)
+    try:
+        start = perf_counter()
+        if ext:
+            for i in range(count):
+                _client.pack(message)
+        else:
+            for i in range(count):
+                msgpack.packb(message, default=_client.dump_hook,
+                    use_bin_type=True)
+        return count / (perf_counter() - start)
+    finally:
+        _client.ext_refs = False
+
+
+def bench_decode(count, items, ext):
+    _client.ext_refs = ext
+    data = _client.pack(object_message(items)) * count
+    _client.ext_refs = False
+    unpacker = msgpack.Unpacker(
+        object_hook=None if ext else _client.load_hook,
+        ext_hook=_client.ext_hook, raw=False)
+    start = perf_counter()
+    unpacker.feed(data)
+    for message in unpacker:
+        pass
+    return count / (perf_counter() - start)
+
+
+def main(count=200000):
+    before = bench_calls(count, coalesce=False)
+    after = bench_calls(count, coalesce=True)
+    print('send per message: %12.0f msg/s' % before)
+    print('coalesced batch:  %12.0f msg/s' % after)
+    print('speedup:          %12.1fx' % (after / before))
+
+    items = [Item() for i in range(20)]
+    for v in items:
+        _client.instantiate(v, 'Item')
+    n = count // 20
+    for name, f in (('encode', bench_encode), ('decode', bench_decode)):
+        before = f(n, items, ext=False)
+        after = f(n, items, ext=True)
+        print('%s maps:      %12.0f msg/s' % (name, before))
+        print('%s ext refs:  %12.0f msg/s' % (name, after))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,346 @@
+"""
+End-to-end benchmarks of an application served by the stand-in master.
+The application is this module started in a subprocess. Run with:
+
+    python -m dice_tools.tests.bench_e2e
+"""
+import sys
+import struct
+import threading
+import lz4framed
+
+from functools import lru_cache, partialmethod
+from time import perf_counter
+from dice_tools import (Application, diceProperty, call, call_ex, call_async,
+    gather, batch, flush, PendingCall, run, process_messages, wizard,
+    _client)
+from dice_tools.helpers.xview import View
+from dice_tools.helpers.xmodel import list_of_dicts_model
+from dice_tools.tests.master import Master
+
+
+class BenchApp(Application):
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.__value = 0
+        self.view = None
+        self.model = None
+
+    @diceProperty(int)
+    def value(self):
+        return self.__value
+
+    @value.setter
+    def value(self, value):
+        self.__value = value
+
+    def ping(self):
+        return True
+
+    def count_up(self, n):
+        for i in range(1, n + 1):
+            self.value = i
+
+    def set_and_output(self, value):
+        with _client.coalesce():
+            self.value = value
+            return self.set_output('t', value)
+
+    def echo_text(self, n):
+        return call_ex(None, 'echo', 'x' * n)
+
+    def wire_stats(self):
+        return _client.stats()['lz4']
+
+    def slow_calls(self, timeout, late):
+        """
+        Makes 'slow' call which times out and one which is cancelled, then
+        processes messages for late seconds while their replies arrive.
+        """
+        try:
+            call_ex(None, 'slow', timeout=timeout)
+            timed_out = False
+        except TimeoutError:
+            timed_out = True
+        future = call_async(None, 'slow')
+        future.cancel()
+        deadline = perf_counter() + late
+        while perf_counter() < deadline:
+            process_messages(0.01)
+        return timed_out, future.cancelled(), len(_client.calls)
+
+    def gather_echoes(self, n):
+        return gather(call_async(None, 'echo', i) for i in range(n))
+
+    def batch_echoes(self, n, fail):
+        calls = []
+        try:
+            with batch():
+                calls.extend(call_ex(None, 'echo', i) for i in range(n))
+                assert all(isinstance(f, PendingCall) and not f.done()
+                    for f in calls)
+                if fail:
+                    raise ValueError
+        except ValueError:
+            return [f.cancelled() for f in calls]
+        return [f.result() for f in calls]
+
+    def thread_batch(self, n):
+        """
+        Makes blocking call while a worker thread has batch() block open.
+        Also tells if sockets were written by this thread only.
+        """
+        inside = threading.Event()
+        resume = threading.Event()
+        result = []
+        writers = set()
+        flush_socket = _client.flush_socket
+
+        def record(s):
+            writers.add(threading.get_ident())
+            return flush_socket(s)
+        _client.flush_socket = record
+
+        def work():
+            with batch() as b:
+                for i in range(n):
+                    call_ex(None, 'echo', i)
+                inside.set()
+                resume.wait(5)
+            result.extend(b.results)
+            flush()
+        worker = threading.Thread(target=work)
+        worker.start()
+        inside.wait(5)
+        try:
+            own = call_ex(None, 'echo', 'loop')
+            resume.set()
+            while worker.is_alive():
+                process_messages(0.01)
+        finally:
+            _client.flush_socket = flush_socket
+        return own, result, writers == {threading.get_ident()}
+
+    def crash_with_output(self, lines, tail):
+        for i in range(lines):
+            print('line', i)
+        sys.stdout.write(tail)
+        # ends the loop, unlike exceptions of handlers
+        wizard.timeout(self.crash)
+
+    def crash(self):
+        raise RuntimeError('crash')
+
+    def start_ticks(self, interval):
+        self.ticks = []
+        self.tick_timer = wizard.timeout(self.tick, interval, -1)
+
+    def tick(self):
+        self.ticks.append(perf_counter())
+
+    def stop_ticks(self):
+        wizard.remove_timeout(self.tick_timer)
+        return self.ticks
+
+    def same(self, a, b):
+        return a is b is self.view
+
+    @lru_cache()
+    def cached(self, n):
+        return n * 2
+
+    def add(self, a, b):
+        return a + b
+
+    add_one = partialmethod(add, 1)
+
+    def round_trips(self, n):
+        times = []
+        for i in range(n):
+            start = perf_counter()
+            call_ex(None, 'echo', i)
+            times.append(perf_counter() - start)
+        return times
+
+    def thread_round_trips(self, n):
+        result = []
+        worker = threading.Thread(
+            target=lambda: result.extend(self.round_trips(n)))
+        worker.start()
+        # worker's calls are sent by this thread
+        while worker.is_alive():
+            process_messages(0.01)
+        return result
+
+    def send_messages(self, n):
+        for i in range(n):
+            call(None, 'bench', i)
+
+    def send_from_threads(self, threads, n):
+        def send(thread):
+            for i in range(n):
+                call(None, 'bench', thread, i)
+        workers = [threading.Thread(target=send, args=(i,))
+            for i in range(threads)]
+        for v in workers:
+            v.start()
+        for v in workers:
+            v.join()
+
+    def create_view(self):
+        self.view = View()
+        return self.view
+
+    def drop_view(self):
+        self.view = None
+
+    def create_model(self):
+        self.model = list_of_dicts_model('name', 'value')
+        return self.model
+
+    def insert_items(self, n):
+        elements = self.model.data.root_item.elements
+        for i in range(n):
+            elements.append({'name': 'item %i' % i, 'value': i})
+
+    def send_frames(self, n, size_x, size_y):
+        frame = bytearray(size_x * size_y * 3)
+        for i in range(1, n + 1):
+            struct.pack_into('<I', frame, 0, i)
+            self.view.update(size_x, size_y, False, bytes(frame))
+
+
+class Frames:
+
+    def __init__(self):
+        self.count = 0
+        self.last = 0
+
+    def __call__(self, master, obj_id, size_x, size_y, data, flip, codec):
+        self.count += 1
+        index, = struct.unpack_from('<I', lz4framed.decompress(data[0]))
+        self.last = max(self.last, index)
+
+
+def timed(f, *args):
+    start = perf_counter()
+    f(*args)
+    return perf_counter() - start
+
+
+def percentile(values, q):
+    return sorted(values)[min(int(q * len(values)), len(values) - 1)]
+
+
+def bench_round_trips(master, n):
+    times = master.call(master.app, 'round_trips', n)
+    print('call_ex round trip:  mean %7.1f us  p50 %7.1f us  p99 %7.1f us' % (
+        sum(times) / n * 1e6, percentile(times, 0.5) * 1e6,
+        percentile(times, 0.99) * 1e6))
+
+
+def bench_outbound(master, n):
+    def f():
+        master.notify(master.app, 'send_messages', n)
+        master.wait_count('bench', n)
+    print('app to master:       %12.0f msg/s' % (n / timed(f)))
+
+
+def bench_threads(master, threads, n):
+    start = master.counts['bench']
+
+    def f():
+        master.notify(master.app, 'send_from_threads', threads, n // threads)
+        master.wait_count('bench', start + n // threads * threads)
+    print('%i threads to master:  %10.0f msg/s' % (threads, n / timed(f)))
+
+
+def bench_property_sync(master, n):
+    def f():
+        master.sync_props(master.app, {'value': [n]}, n)
+        master.call(master.app, 'ping')
+    print('property sync:       %12.0f msg/s' % (n / timed(f)))
+
+
+def bench_property_updates(master, n):
+    start = master.counts['__dice_set_property__']
+
+    def f():
+        master.call(master.app, 'count_up', n)
+        master.wait(lambda: master.properties[master.app]['value'] == n)
+    elapsed = timed(f)
+    print('property updates:    %12.0f sets/s, %i of %i sent' % (n / elapsed,
+        master.counts['__dice_set_property__'] - start, n))
+
+
+def bench_mouse(master, view_id, n):
+    def f():
+        master.mouse_stream(view_id, n)
+        master.call(master.app, 'ping')
+    print('mouse stream:        %12.0f msg/s' % (n / timed(f)))
+
+
+def timer_gaps(master, view_id, n, interval=0.01):
+    """
+    Gaps between ticks of application timer while it handles n mouse moves.
+    """
+    master.call(master.app, 'start_ticks', interval)
+    master.mouse_stream(view_id, n)
+    master.call(master.app, 'ping')
+    ticks = master.call(master.app, 'stop_ticks')
+    return [b - a for a, b in zip(ticks, ticks[1:])]
+
+
+def bench_timer_jitter(master, view_id, n):
+    gaps = timer_gaps(master, view_id, n)
+    print('10 ms timer under load: p50 %5.1f ms  p99 %5.1f ms  max %5.1f ms' % (
+        percentile(gaps, 0.5) * 1e3, percentile(gaps, 0.99) * 1e3,
+        max(gaps) * 1e3))
+
+
+def bench_model_insert(master, n):
+    model = master.call(master.app, 'create_model')['__object__']
+    master.fetch_items(model)
+    start = master.counts['x_model_insert_items']
+
+    def f():
+        master.notify(master.app, 'insert_items', n)
+        master.wait_count('x_model_insert_items', start + n)
+    print('model insert:        %12.0f items/s' % (n / timed(f)))
+
+
+def bench_frames(master, frames, view_id, n, size_x, size_y):
+    def f():
+        master.notify(master.app, 'send_frames', n, size_x, size_y)
+        master.wait(lambda: frames.last == n)
+    elapsed = timed(f)
+    print('View.update %ix%i: %8.1f frames/s, %i of %i delivered' % (
+        size_x, size_y, n / elapsed, frames.count, n))
+
+
+def main(n=20000):
+    frames = Frames()
+    handlers = {
+        'echo': lambda master, obj_id, value: value,
+        '_update': frames,
+        }
+    with Master(handlers) as master:
+        master.launch('-m', 'dice_tools.tests.bench_e2e', '--app')
+        bench_round_trips(master, n // 10)
+        bench_outbound(master, n)
+        bench_threads(master, 4, n)
+        bench_property_sync(master, n)
+        bench_property_updates(master, n)
+        view = master.call(master.app, 'create_view')['__object__']
+        bench_mouse(master, view, n)
+        bench_timer_jitter(master, view, n * 2)
+        bench_model_insert(master, n // 10)
+        bench_frames(master, frames, view, 200, 640, 480)
+
+
+if __name__ == '__main__':
+    if '--app' in sys.argv:
+        run()
+    else:
+        main()
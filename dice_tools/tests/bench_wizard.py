@@ -0,0 +1,60 @@
+"""
+Benchmarks of wizard event dispatch. Run with:
+
+    python -m dice_tools.tests.bench_wizard
+"""
+from time import perf_counter
+from dice_tools import wizard
+
+
+class Subscriber:
+
+    def __init__(self):
+        self.count = 0
+
+    def w_bench_event(self, value):
+        self.count += 1
+
+
+class Item:
+    pass
+
+
+def bench_events(subscribers, calls=200000, items=0):
+    """
+    Emits events to method subscribers, with items subscribed to elsewhere
+    so that arguments have to be looked up too.
+
+    :return float: Events per second.
+    """
+    subs = [Subscriber() for i in range(subscribers)]
+    for v in subs:
+        wizard.subscribe('w_bench_event', v)
+    watched = [Item() for i in range(items)]
+    for v in watched:
+        wizard.subscribe(subs[0], v)
+    n = max(calls // subscribers, 10)
+    value = Item()
+    try:
+        start = perf_counter()
+        for i in range(n):
+            wizard.w_bench_event(value)
+        elapsed = perf_counter() - start
+        assert sum(v.count for v in subs) == n * subscribers
+        return n / elapsed
+    finally:
+        for v in subs:
+            wizard.unsubscribe(v)
+
+
+def main():
+    wizard.setup(lambda: None)
+    for subscribers in (1, 100, 10000):
+        print('%-30s %10.0f events/s' % ('%i subscribers' % subscribers,
+            bench_events(subscribers)))
+    print('%-30s %10.0f events/s' % ('1 subscriber, 1000 items',
+        bench_events(1, items=1000)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,387 @@
+"""
+Stand-in DICE master for tests and benchmarks. It launches application
+script as a subprocess connected to it over loopback, keeps track of
+registered types, objects and properties, answers blocking calls and can
+send calls and synthetic load to application objects::
+
+    with Master() as master:
+        master.launch('my_app.py')
+        master.call(master.app, 'run', 0, 0)
+"""
+import sys
+import socket
+import struct
+import subprocess
+import threading
+import traceback
+import msgpack
+import lz4framed
+
+from collections import Counter
+from itertools import count
+from dice_tools import _client
+
+
+class CallError(Exception):
+    pass
+
+
+class Master:
+    """
+    :param handlers: Functions by method name called as
+        handler(master, obj_id, *args) for every message of that name
+        received. Value returned from handler is the result for blocking
+        calls, others are answered with None.
+    :param settings: Value returned for app_settings.
+    :param snapshot: Accept connect snapshot if application offers it.
+    :param refs: Accept object references as ext type if application offers
+        it. Received references are {'__object__': handle} either way.
+    :param chunk: Accept bulk messages split into chunks if application
+        offers it.
+    :param lz4: Accept lz4 compressed messages of at least this many bytes
+        if application offers compression.
+    :param oob: Accept buffers of at least this many bytes sent out of band
+        if application offers it.
+    :param wire: Answer wire options offered by application. Without it
+        master acts like one which doesn't know them.
+    """
+
+    def __init__(self, handlers=None, settings=None, snapshot=False,
+            refs=False, chunk=False, lz4=None, oob=None, wire=True):
+        self.handlers = {
+            'app_settings': lambda master, obj_id: master.settings,
+            }
+        self.handlers.update(handlers or ())
+        self.settings = settings if settings is not None else {}
+        self.snapshot = snapshot
+        self.refs = refs
+        self.chunk = chunk
+        self.chunks = []
+        self.lz4 = lz4
+        self.oob = oob
+        self.wire = wire
+        self.oob_buffers = []
+        self.compressed = 0
+        self.oob_bytes = 0
+
+        self.app = None
+        self.instance_id = None
+        self.types = {}
+        self.objects = {}
+        self.properties = {}
+        self.counts = Counter()
+        self.results = {}
+        self.resets = {}
+        self.call_ids = count(1)
+        self.closed = False
+
+        self.changed = threading.Condition()
+        self.send_lock = threading.Lock()
+        self.process = None
+        self.conn = None
+        self.server = socket.socket()
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(1)
+        self.address = self.server.getsockname()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def argv(self, instance_id='instance', workflow_dir='.', progress=0):
+        return [
+            '--dice-addr', self.address[0],
+            '--dice-port', str(self.address[1]),
+            '--dice-progress', str(progress),
+            '--dice-instance-id', instance_id,
+            '--dice-workflow-dir', workflow_dir
+            ]
+
+    def launch(self, *args, timeout=30, **kwargs):
+        """
+        Starts python with arguments and DICE connection arguments, waits
+        until application connects and is ready.
+
+        :param kwargs: Passed to argv.
+        """
+        self.process = subprocess.Popen(
+            [sys.executable] + list(args) + self.argv(**kwargs))
+        self.accept(timeout)
+
+    def accept(self, timeout=30):
+        self.server.settimeout(timeout)
+        self.conn, _ = self.server.accept()
+        self.conn.settimeout(None)
+        self.conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.closed = False
+        self.reader = threading.Thread(target=self.serve, daemon=True)
+        self.reader.start()
+        self.wait(lambda: self.app is not None, timeout)
+
+    def drop(self, timeout=30):
+        """
+        Drops connection like restarted DICE would, forgets state of the
+        application and waits until it connects again.
+        """
+        self.conn.shutdown(socket.SHUT_RDWR)
+        self.conn.close()
+        self.reader.join(timeout)
+        with self.changed:
+            self.app = None
+            self.types.clear()
+            self.objects.clear()
+            self.properties.clear()
+            self.resets.clear()
+            self.counts.clear()
+        self.accept(timeout)
+
+    def serve(self):
+        handshake = b''
+        while not handshake.endswith(b'\x00'):
+            data = self.conn.recv(1)
+            if not data:
+                return self.lost()
+            handshake += data
+        self.instance_id = handshake[:-1].decode('utf8')
+        if self.oob is not None:
+            return self.serve_oob()
+
+        unpacker = msgpack.Unpacker(raw=False, ext_hook=self.ext_hook,
+            max_buffer_size=_client.message_max)
+        buf = bytearray(1 << 16)
+        while True:
+            try:
+                size = self.conn.recv_into(buf)
+            except OSError:
+                size = 0
+            if not size:
+                return self.lost()
+            unpacker.feed(memoryview(buf)[:size])
+            with self.changed:
+                for message in unpacker:
+                    self.handle(*message)
+                self.changed.notify_all()
+
+    def serve_oob(self):
+        """
+        Reads messages followed by out of band buffers. Unpacker is made for
+        every message, so that its position is where the buffers start.
+        """
+        data = bytearray()
+        while True:
+            try:
+                received = self.conn.recv(1 << 16)
+            except OSError:
+                received = b''
+            if not received:
+                return self.lost()
+            data += received
+            with self.changed:
+                while True:
+                    buffers = self.oob_buffers = []
+                    unpacker = msgpack.Unpacker(raw=False,
+                        ext_hook=self.ext_hook,
+                        max_buffer_size=_client.message_max)
+                    unpacker.feed(data)
+                    try:
+                        message = next(unpacker)
+                    except StopIteration:
+                        break
+                    pos = unpacker.tell()
+                    end = pos + sum(len(v) for v in buffers)
+                    if end > len(data):
+                        break
+                    for v in buffers:
+                        v[:] = data[pos:pos + len(v)]
+                        pos += len(v)
+                    self.oob_bytes += end - unpacker.tell()
+                    del data[:end]
+                    self.handle(*message)
+                self.changed.notify_all()
+
+    def ext_hook(self, code, data):
+        if code == _client.EXT_LZ4:
+            self.compressed += 1
+            return msgpack.unpackb(lz4framed.decompress(data), raw=False,
+                ext_hook=self.ext_hook)
+        if code == _client.EXT_OOB:
+            buffer = bytearray(struct.unpack('>Q', data)[0])
+            self.oob_buffers.append(buffer)
+            return buffer
+        if code == _client.EXT_OBJECT:
+            return {'__object__': int.from_bytes(data, 'big')}
+        return msgpack.ExtType(code, data)
+
+    def handle(self, obj_id, name, call_id, *args):
+        self.counts[name] += 1
+        if name in ('result', 'error'):
+            self.results[args[0]] = (name, args[1] if len(args) > 1 else None)
+            return
+        if name == 'register':
+            self.types[args[0]] = args[1]
+        elif name == 'new':
+            self.objects[args[0]] = args[2]
+        elif name == 'delete':
+            self.objects.pop(args[0], None)
+            self.properties.pop(args[0], None)
+        elif name == 'ready':
+            self.app = args[0]['__object__']
+        elif name == '__dice_set_property__':
+            self.properties.setdefault(obj_id, {})[args[0]] = args[1]
+        elif name == 'snapshot':
+            snapshot = args[0]
+            for type_id, type_name, *info in snapshot['types']:
+                self.types[type_id] = type_name
+            for obj, type_id, type_name in snapshot['objects']:
+                self.objects[obj] = type_name
+            for obj, values in snapshot['properties']:
+                self.properties.setdefault(obj, {}).update(values)
+        elif name == 'x_model_reset':
+            self.resets[obj_id] = args[0]
+        elif name == 'connect':
+            # DICE lets objects send their state once their peer exists
+            self.reply(call_id, None)
+            self.notify(obj_id, 'connected')
+            return
+        elif name == 'wire':
+            if not self.wire:
+                return
+            accepted = {}
+            if self.lz4 is not None:
+                accepted['lz4'] = self.lz4
+            if self.oob is not None:
+                accepted['oob'] = self.oob
+            if self.snapshot:
+                accepted['snapshot'] = 1
+            if self.refs:
+                accepted['ref'] = 1
+            if self.chunk:
+                accepted['chunk'] = 0
+            self.reply(call_id, accepted)
+            return
+        elif name == 'chunk':
+            final, data = args
+            self.chunks.append(data)
+            if final:
+                unpacker = msgpack.Unpacker(raw=False, ext_hook=self.ext_hook,
+                    max_buffer_size=_client.message_max)
+                unpacker.feed(b''.join(self.chunks))
+                del self.chunks[:]
+                for message in unpacker:
+                    self.handle(*message)
+            return
+
+        handler = self.handlers.get(name)
+        try:
+            result = handler(self, obj_id, *args) if handler else None
+        except Exception:
+            traceback.print_exc()
+            if call_id is not None:
+                self.send(None, 'error', None, call_id,
+                    traceback.format_exc())
+            return
+        self.reply(call_id, result)
+
+    def reply(self, call_id, result):
+        if call_id is not None:
+            self.send(None, 'result', None, call_id, result)
+
+    def lost(self):
+        with self.changed:
+            self.closed = True
+            self.changed.notify_all()
+
+    def wait(self, predicate, timeout=30):
+        """
+        Waits until predicate becomes true with received messages.
+        """
+        with self.changed:
+            if not self.changed.wait_for(
+                    lambda: predicate() or self.closed, timeout):
+                raise TimeoutError('master wait timed out')
+        if not predicate():
+            raise ConnectionError('application disconnected')
+
+    def wait_count(self, name, n, timeout=30):
+        self.wait(lambda: self.counts[name] >= n, timeout)
+
+    def pack(self, obj_id, name, call_id, *args):
+        return msgpack.packb((obj_id, name, call_id) + args,
+            use_bin_type=True)
+
+    def write(self, data):
+        with self.send_lock:
+            self.conn.sendall(data)
+
+    def send(self, obj_id, name, call_id=None, *args):
+        self.write(self.pack(obj_id, name, call_id, *args))
+
+    def notify(self, obj_id, name, *args):
+        """
+        Calls method of application object without waiting for result.
+        """
+        self.send(obj_id, name, None, *args)
+
+    def call(self, obj_id, name, *args, timeout=30):
+        """
+        Calls method of application object and waits for its result.
+        """
+        call_id = next(self.call_ids)
+        self.send(obj_id, name, call_id, *args)
+        self.wait(lambda: call_id in self.results, timeout)
+        kind, value = self.results.pop(call_id)
+        if kind == 'error':
+            raise CallError(value)
+        return value
+
+    def stream(self, messages):
+        """
+        Sends (obj_id, name, *args) notifications in one write.
+        """
+        self.write(b''.join(
+            self.pack(obj_id, name, None, *args)
+            for obj_id, name, *args in messages))
+
+    def sync_props(self, obj_id, props, n):
+        """
+        Sends n property syncs like QML does when properties are edited.
+        """
+        self.stream((obj_id, '__dice_sync_props__', props)
+            for i in range(n))
+
+    def sync_values(self, obj_id, path, values):
+        self.stream((obj_id, '__dice_sync_value__', path, v) for v in values)
+
+    def mouse_stream(self, view_id, n, modifiers=()):
+        """
+        Sends n mouse moves along a diagonal to view.
+        """
+        self.stream((view_id, 'mouse_move', i % 1000, i % 1000,
+            list(modifiers)) for i in range(n))
+
+    def fetch_items(self, model_id, item_id=None):
+        """
+        Expands model item, root item by default.
+        """
+        if item_id is None:
+            self.wait(lambda: model_id in self.resets)
+            item_id = self.resets[model_id]
+        self.notify(model_id, 'n_model_fetch_items', item_id)
+
+    def close(self, timeout=10):
+        self.server.close()
+        if self.conn is not None:
+            try:
+                self.conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.conn.close()
+            self.conn = None
+        if self.process is not None:
+            try:
+                self.process.wait(timeout)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
@@ -0,0 +1,517 @@
+from dice_tools.tests.master import Master, CallError
+from dice_tools.tests.bench_e2e import Frames, timer_gaps
+from dice_tools import _client, call, wizard, replay
+from time import time, sleep, monotonic
+from contextlib import contextmanager
+import json
+import socket
+import subprocess
+import struct
+import sys
+import threading
+import msgpack
+import pytest
+
+wizard.setup(lambda: None)
+
+echo = {'echo': lambda master, obj_id, value: value}
+
+@contextmanager
+def launched(*args, app=('dice_tools.tests.bench_e2e', '--app'),
+        terminate=False, **kwargs):
+    """
+    Master made with kwargs serving application module started with more
+    arguments args. Application which would keep running, like one which
+    reconnects, is terminated when the block exits.
+    """
+    with Master(**kwargs) as master:
+        master.launch('-m', *app + args)
+        try:
+            yield master
+        finally:
+            if terminate:
+                master.process.terminate()
+
+@pytest.fixture(scope='module')
+def master():
+    handlers = dict(echo,
+        bench=lambda master, obj_id, *args: master.received.append(args),
+        slow=lambda master, obj_id: sleep(0.2) or 'late',
+        set_output=lambda master, obj_id, type_name, value:
+            master.properties[obj_id]['value'])
+    with launched(handlers=handlers) as master:
+        master.received = []
+        yield master
+    assert master.process.returncode == 0
+
+def test_connect(master):
+    assert master.instance_id == 'instance'
+    assert master.objects[master.app] == 'BasicApp'
+    assert 'BenchApp' in master.types.values()
+    master.wait(lambda: master.app in master.properties)
+    assert master.properties[master.app]['value'] == 0
+
+def test_call(master):
+    assert master.call(master.app, 'ping') is True
+    assert len(master.call(master.app, 'round_trips', 3)) == 3
+
+def test_call_from_thread(master):
+    assert len(master.call(master.app, 'thread_round_trips', 3)) == 3
+
+def test_calls_from_threads(master):
+    del master.received[:]
+    master.call(master.app, 'send_from_threads', 4, 500)
+    master.wait(lambda: len(master.received) == 2000)
+    for thread in range(4):
+        assert [i for t, i in master.received if t == thread] == list(
+            range(500))
+
+def test_pending_calls(master):
+    assert master.call(master.app, 'slow_calls', 0.05, 0.6) == [True, True, 0]
+    assert master.counts['slow'] == 2
+    assert master.call(master.app, 'gather_echoes', 10) == list(range(10))
+
+def test_batch(master):
+    assert master.call(master.app, 'batch_echoes', 5, False) == list(range(5))
+    assert master.call(master.app, 'batch_echoes', 5, True) == [True] * 5
+    assert master.call(master.app, 'thread_batch', 5) == ['loop',
+        list(range(5)), True]
+    assert master.call(master.app, 'ping') is True
+
+def test_unknown_method(master):
+    with pytest.raises(CallError):
+        master.call(master.app, '_private')
+    with pytest.raises(CallError):
+        master.call(1 << 40, 'ping')
+
+def test_decorated_method(master):
+    assert master.call(master.app, 'cached', 4) == 8
+    assert master.call(master.app, 'add_one', 4) == 5
+    with pytest.raises(CallError):
+        master.call(master.app, 'value')
+
+def test_property_sync(master):
+    master.sync_props(master.app, {'value': [5]}, 1)
+    assert master.call(master.app, '__dice_sync_props__', {'value': []}) == {
+        'value': 5}
+
+def test_property_before_blocking_call(master):
+    assert master.call(master.app, 'set_and_output', 21) == 21
+    assert master.call(master.app, 'set_and_output', 22) == 22
+
+def test_property_updates_merged(master):
+    start = master.counts['__dice_set_property__']
+    master.call(master.app, 'count_up', 10000)
+    master.wait(lambda: master.properties[master.app]['value'] == 10000)
+    assert master.counts['__dice_set_property__'] - start < 100
+
+def test_timer_under_load(master):
+    view = master.call(master.app, 'create_view')['__object__']
+    assert max(timer_gaps(master, view, 20000)) < 0.1
+
+def test_collected_object_deleted(master):
+    view = master.call(master.app, 'create_view')['__object__']
+    assert master.objects[view] == 'ExposedView'
+    master.call(master.app, 'drop_view')
+    master.wait(lambda: view not in master.objects)
+
+def test_collected_object_rejected(master):
+    view = master.call(master.app, 'create_view')
+    master.call(master.app, 'drop_view')
+    master.wait(lambda: view['__object__'] not in master.objects)
+    for ref in (view, {'__object__': 1 << 30}):
+        with pytest.raises(CallError):
+            master.call(master.app, 'same', ref, ref)
+    assert master.call(master.app, 'ping') is True
+
+def test_object_without_handle():
+    obj = object()
+    with pytest.raises(ValueError):
+        _client.pin(obj)
+    assert None not in _client.pins
+    pending = len(_client.calls)
+    for f in (_client.call, _client.call_async):
+        with pytest.raises(ValueError):
+            f(obj, 'ping')
+    assert len(_client.calls) == pending
+
+def test_stats(tmp_path):
+    path = tmp_path / 'stats.json'
+    with launched('--dice-stats', str(path), handlers=echo) as master:
+        for i in range(3):
+            master.call(master.app, 'ping')
+        master.call(master.app, 'round_trips', 4)
+        # grows read buffer
+        master.call(master.app, 'same', bytes(100000), None)
+    stats = json.loads(path.read_text())
+    assert stats['inbound']['BenchApp.ping']['count'] == 3
+    assert stats['inbound']['BenchApp.ping']['time']['count'] == 3
+    assert stats['inbound']['BenchApp.round_trips']['bytes'] > 0
+    assert stats['outbound']['echo']['count'] == 4
+    assert stats['outbound']['result']['count'] >= 4
+    assert stats['round_trip']['echo']['count'] == 4
+    assert stats['round_trip']['echo']['max'] > 0
+    assert stats['read']['bytes'] > 0
+    assert stats['read']['reads'] <= stats['read']['bytes']
+    assert stats['read']['buffer_max'] > _client.recv_size
+
+def test_record_replay(tmp_path):
+    path = str(tmp_path / 'session.rec')
+    with launched('--dice-record', path, handlers=echo) as master:
+        master.call(master.app, 'count_up', 5)
+        view = master.call(master.app, 'create_view')
+        assert master.call(master.app, 'same', view, view) is True
+        master.call(master.app, 'round_trips', 3)
+    header, records = replay.read_session(path)
+    assert header['instance_id'] == 'instance'
+    inbound = sum(1 for ts, n, direction, message in records
+        if n == 0 and direction == 'in')
+
+    replayer = replay.Replayer(path, speed=None)
+    replayer.start()
+    process = subprocess.Popen([sys.executable, '-m',
+        'dice_tools.tests.bench_e2e', '--app'] + replayer.argv())
+    try:
+        replayer.join(30)
+        assert process.wait(30) == 0
+    finally:
+        process.kill()
+    assert replayer.error is None
+    assert replayer.skipped == 0
+    assert replayer.sent == inbound
+
+@pytest.mark.parametrize('lz4', [None, 0])
+def test_lz4(lz4):
+    with launched('--dice-compress', '1024', handlers=echo,
+            lz4=lz4) as master:
+        assert master.call(master.app, 'echo_text', 100) == 'x' * 100
+        assert master.compressed == 0
+        assert master.call(master.app, 'echo_text', 100000) == 'x' * 100000
+        # the call and its result
+        assert master.compressed == (0 if lz4 is None else 2)
+        stats = master.call(master.app, 'wire_stats')
+    if lz4 is None:
+        assert stats['lz4_in'] == 0
+    else:
+        assert 200000 <= stats['lz4_in'] and stats['lz4_out'] < 10000
+
+def test_wire_unanswered():
+    start = time()
+    with launched('--dice-compress', '1024', handlers=echo, lz4=0,
+            wire=False) as master:
+        assert time() - start < _client.wire_timeout + 10
+        assert master.call(master.app, 'echo_text', 100000) == 'x' * 100000
+        assert master.compressed == 0
+
+def test_oob():
+    frames = Frames()
+    with launched('--dice-oob', '1024', handlers={'_update': frames},
+            oob=0) as master:
+        master.call(master.app, 'create_view')
+        master.call(master.app, 'send_frames', 5, 640, 480)
+        master.wait(lambda: frames.last == 5)
+        assert master.oob_bytes > 0
+        assert master.call(master.app, 'ping') is True
+
+def test_oob_buffers_kept():
+    data = bytearray(b'a' * 100)
+    frozen = b'b' * 100
+    args, buffers = _client.split_buffers((data, [frozen]), 10)
+    data[:] = b'c' * 100
+    assert bytes(buffers[0]) == b'a' * 100
+    assert buffers[1].obj is frozen
+
+def test_snapshot():
+    with launched('--dice-snapshot', snapshot=True) as master:
+        assert master.counts['snapshot'] == 1
+        assert not master.counts['new'] and not master.counts['connect']
+        assert master.counts['set_tasks'] == 1
+        assert master.objects[master.app] == 'BasicApp'
+        assert master.properties[master.app]['value'] == 0
+        assert master.call(master.app, 'ping') is True
+
+def test_reconnect():
+    with launched('--dice-reconnect', terminate=True) as master:
+        master.sync_props(master.app, {'value': [7]}, 1)
+        master.call(master.app, 'ping')
+        master.drop()
+        assert master.objects[master.app] == 'BasicApp'
+        master.wait(lambda: master.app in master.properties)
+        assert master.properties[master.app]['value'] == 7
+        assert master.call(master.app, 'ping') is True
+
+def test_reconnect_clock_set(monkeypatch):
+    closed = socket.socket()
+    closed.bind(('127.0.0.1', 0))
+    address = closed.getsockname()
+    closed.close()
+    scheduled = []
+    monkeypatch.setattr(_client, 'reconnect', address)
+    monkeypatch.setattr(_client, 'reconnect_since', monotonic())
+    monkeypatch.setattr(_client, 'reconnect_wait', _client.reconnect_delay)
+    monkeypatch.setattr(wizard, 'timeout', lambda *args: scheduled.append(args))
+    # wall clock jumps past reconnect_give_up
+    monkeypatch.setattr(_client, 'time',
+        lambda: monotonic() + _client.reconnect_give_up * 2)
+    _client.try_reconnect()
+    assert scheduled == [(_client.try_reconnect, _client.reconnect_delay * 2)]
+
+def test_object_refs():
+    with launched('--dice-refs', refs=True) as master:
+        view = master.call(master.app, 'create_view')['__object__']
+        assert master.objects[view] == 'ExposedView'
+        ref = msgpack.ExtType(_client.EXT_OBJECT, bytes([view]))
+        assert master.call(master.app, 'same', ref, ref) is True
+        # maps are not references once EXT_OBJECT is accepted
+        assert master.call(master.app, 'same', {'__object__': view},
+            ref) is False
+
+def test_property_clock_set_back(pair, monkeypatch):
+    a, b = pair
+    b.setblocking(False)
+    # wall clock keeps going back
+    monkeypatch.setattr(_client, 'time', lambda: -monotonic())
+    with _client.coalesce():
+        _client.set_property(None, 'value', 5)
+    assert receive(b, 1) == [['__dice_set_property__', 'value', 5]]
+
+def test_flush_clock_set_back(pair, monkeypatch):
+    a, b = pair
+    b.setblocking(False)
+    monkeypatch.setattr(_client, 'time', lambda: -monotonic())
+    with _client.coalesce():
+        call(None, 'notify', 1)
+        sleep(_client.flush_interval * 1.5)
+        call(None, 'notify', 2)
+        # written inside the long block
+        unpacker = msgpack.Unpacker(raw=False)
+        unpacker.feed(b.recv(1 << 16))
+        assert [v[3] for v in unpacker] == [1, 2]
+
+def test_lanes(pair):
+    a, b = pair
+    _client.chunk[a] = 1000
+    with _client.coalesce():
+        call(None, 'stdout', 'line')
+        call(None, 'log')
+        call(None, 'stdout', 'task')
+        call(None, '_update', bytes(5000))
+        call(None, 'notify', 1)
+        call(None, 'result', 1, None)
+        call(None, 'notify', bytes(100000))
+    names = []
+
+    def read():
+        unpacker = msgpack.Unpacker(raw=False)
+        while len(names) < 12:
+            unpacker.feed(b.recv(1 << 16))
+            names.extend(v[1] for v in unpacker)
+    reader = threading.Thread(target=read, daemon=True)
+    reader.start()
+    process_until(lambda: not reader.is_alive())
+    assert names == (['result', 'notify', 'notify'] + ['chunk'] * 6 +
+        ['stdout', 'log', 'stdout'])
+
+def test_chunks():
+    frames = Frames()
+    with launched('--dice-chunk', '1024', handlers={'_update': frames},
+            chunk=True) as master:
+        master.call(master.app, 'create_view')
+        master.call(master.app, 'send_frames', 5, 640, 480)
+        master.wait(lambda: frames.last == 5)
+        assert master.counts['chunk'] > 5
+
+def test_idle():
+    fired = []
+
+    def w_idle():
+        fired.append(time())
+    wizard.subscribe(w_idle)
+    try:
+        _client.activity()
+        start = time()
+        while not fired:
+            _client.process_messages(1)
+        assert fired[0] - start < _client.idle_quiet * 2
+        assert wizard.get_delta() is None
+    finally:
+        wizard.unsubscribe(w_idle)
+
+def test_idle_clock_set(monkeypatch):
+    fired = []
+
+    def w_idle():
+        fired.append(True)
+    wizard.subscribe(w_idle)
+    # wall clock stopped or set back doesn't delay idle
+    monkeypatch.setattr(_client, 'time', lambda: 0.0)
+    try:
+        _client.activity()
+        process_until(lambda: fired, _client.idle_quiet * 10)
+    finally:
+        wizard.unsubscribe(w_idle)
+
+@pytest.fixture
+def pair():
+    """
+    Socket connected to the client in this process and its other end.
+    """
+    a, b = socket.socketpair()
+    _client.add_socket(a)
+    b.settimeout(5)
+    yield a, b
+    if a in _client.socks:
+        _client.disconnect(a)
+    b.close()
+
+def process_until(predicate, timeout=5):
+    deadline = time() + timeout
+    while not predicate() and time() < deadline:
+        _client.process_messages(0.05)
+    assert predicate()
+
+def send(sock, *parts):
+    """
+    Writes parts with a pause after each in a thread, so that the client
+    receives them in separate reads.
+    """
+    def write():
+        for v in parts:
+            sock.sendall(v)
+            sleep(0.05)
+    threading.Thread(target=write, daemon=True).start()
+
+@pytest.mark.parametrize('size', [10, 1000, 100000])
+def test_oob_inbound(pair, size):
+    a, b = pair
+    got = []
+    _client.handlers['oob_test'] = lambda i, data: got.append((i, bytes(data)))
+    try:
+        payloads = [bytes([i]) * size for i in range(4)]
+        data = b''.join(msgpack.packb((None, 'oob_test', None, i,
+            msgpack.ExtType(_client.EXT_OOB, struct.pack('>Q', size))),
+            use_bin_type=True) + v for i, v in enumerate(payloads))
+        # back to back, then split in the middle of a payload
+        send(b, data)
+        process_until(lambda: len(got) == 4)
+        half = len(data) // 2 + 3
+        send(b, data[:half], data[half:])
+        process_until(lambda: len(got) == 8)
+        assert got == list(enumerate(payloads)) * 2
+    finally:
+        del _client.handlers['oob_test']
+
+def receive(sock, n):
+    """
+    Processes messages until n messages are read from non-blocking sock.
+    """
+    unpacker = msgpack.Unpacker(raw=False)
+    messages = []
+
+    def more():
+        try:
+            unpacker.feed(sock.recv(1 << 16))
+        except BlockingIOError:
+            pass
+        messages.extend(v[1:2] + v[3:] for v in unpacker)
+        return len(messages) >= n
+    process_until(more)
+    return messages
+
+@pytest.fixture
+def console(pair, monkeypatch):
+    monkeypatch.setattr(_client, 'console_sent', 0.0)
+    monkeypatch.setattr(_client, 'console_window', monotonic())
+    monkeypatch.setattr(_client, 'console_count', 0)
+    pair[1].setblocking(False)
+    return pair
+
+def test_console_leading_edge(console):
+    a, b = console
+    _client.console_write('stdout', 'before busy\n')
+    # sent without processing messages
+    assert receive(b, 1) == [['stdout', 'before busy']]
+    start = time()
+    _client.console_write('stdout', 'next\n')
+    with pytest.raises(BlockingIOError):
+        b.recv(1)
+    assert receive(b, 1) == [['stdout', 'next']]
+    assert time() - start >= _client.console_interval * 0.9
+
+def test_console_clock_set_back(console, monkeypatch):
+    a, b = console
+    monkeypatch.setattr(_client, 'time', lambda: -monotonic())
+    _client.console_write('stdout', 'a\n')
+    _client.console_write('stdout', 'b\n')
+    assert receive(b, 2) == [['stdout', 'a'], ['stdout', 'b']]
+
+def test_console_order(console):
+    a, b = console
+    _client.console_write('stdout', 'a\n')
+    _client.console_write('stdout', 'b\nc')
+    _client.console_write('stderr', 'd\n')
+    _client.console_write('stdout', '\ne\n')
+    assert receive(b, 4) == [['stdout', 'a'], ['stdout', 'b'],
+        ['stderr', 'd'], ['stdout', 'c\ne']]
+
+def test_console_rate(console, monkeypatch):
+    a, b = console
+    monkeypatch.setattr(_client, 'console_rate', 5)
+    _client.console_write('stdout', 'x\n' * 8)
+    _client.console_write('stdout', 'y\n')
+    assert receive(b, 1) == [['stdout', '\n'.join('x' * 5)]]
+    assert receive(b, 1) == [['stderr', '[4 lines suppressed]']]
+    _client.console_write('stdout', 'z\n')
+    assert receive(b, 1) == [['stdout', 'z']]
+
+def test_console_unlimited(console):
+    a, b = console
+    _client.console_write('stdout', 'x\n' * 5000)
+    assert receive(b, 1) == [['stdout', '\n'.join('x' * 5000)]]
+
+def test_console_on_crash():
+    output = []
+    handlers = {'stdout': lambda master, obj_id, text: output.append(text)}
+    with launched(handlers=handlers) as master:
+        master.notify(master.app, 'crash_with_output', 100, 'tail')
+        master.wait(lambda: master.closed)
+    assert master.process.returncode == 1
+    assert '\n'.join(output) == '\n'.join(
+        ['line %i' % i for i in range(100)] + ['tail'])
+
+def test_aio():
+    handlers = dict(echo, slow=lambda master, obj_id: sleep(0.3) or 'late')
+    with launched(app=('dice_tools.tests.aio_app',), handlers=handlers,
+            settings={'value': 42}) as master:
+        assert master.objects[master.app] == 'BasicApp'
+        assert master.call(master.app, 'ping') is True
+        assert master.call(master.app, 'blocking', 'b') == 'b'
+        assert master.call(master.app, 'echo_all', 5) == list(range(5))
+        assert 0.09 < master.call(master.app, 'wait_timer', 0.1) < 1
+        assert master.call(master.app, 'cancel_slow', 0.05, 0.5) == [0, 0]
+        assert master.call(master.app, 'run', 0, 0) is True
+        master.wait(lambda: master.properties[master.app]['value'] == 42)
+        assert master.call(master.app, 'ping') is True
+    assert master.process.returncode == 0
+
+def test_refs_hook_dropped(pair):
+    a, b = pair
+    got = []
+    _client.handlers['ref_test'] = lambda *args: got.append(args)
+    ref = {'__object__': 1 << 30}
+    message = msgpack.packb((None, 'ref_test', None, ref), use_bin_type=True)
+    plain = msgpack.packb((None, 'ref_test', None, 'plain'),
+        use_bin_type=True)
+    try:
+        # unknown reference, rejected
+        b.sendall(message + plain)
+        process_until(lambda: got)
+        assert got == [('plain',)]
+        assert a in _client.hooked
+        _client.ref_socks.add(a)
+        b.sendall(message * 2)
+        process_until(lambda: len(got) == 3)
+        assert got[1:] == [(ref,), (ref,)]
+        assert a not in _client.hooked
+    finally:
+        del _client.handlers['ref_test']
@@ -4,6 +4,9 @@ from pprint import pprint
 from unittest.mock import Mock
 import pytest
 import gc
+import time
+import random
+import threading
 
 wizard.setup(lambda: None)
 
@@ -151,6 +154,86 @@ def test_condition_replace_method():
     sub.mock.assert_any_call(1, 2, 3, 'red', test='wow')
     sub.mock.assert_any_call('red', 1, 2, 3, test='wow')
 
+def test_dispatch_cache():
+    sub1 = SomeClass()
+    sub2 = SomeClass()
+    wizard.subscribe('method', sub1)
+    wizard.method(1)
+    wizard.subscribe('method', sub2)
+    wizard.method(2)
+    sub1.mock.assert_called_with(2)
+    sub2.mock.assert_called_once_with(2)
+    wizard.unsubscribe('method', sub1)
+    wizard.method(3)
+    sub1.mock.assert_called_with(2)
+    sub2.mock.assert_called_with(3)
+    sub2 = None
+    gc.collect()
+    wizard.method(4)
+    assert 'method' not in wizard.compiled
+
+def test_dispatch_from_thread():
+    sub = SomeClass()
+    wizard.subscribe('method', sub)
+    t = threading.Thread(target=lambda: wizard.method(5))
+    t.start()
+    t.join()
+    assert 'method' not in wizard.compiled
+    assert not sub.mock.called
+    for f in wizard.get_callbacks():
+        f()
+    sub.mock.assert_called_once_with(5)
+    wizard.unsubscribe(sub)
+
+def run_timeouts():
+    fired = wizard.get_timeouts()
+    for f in fired:
+        f()
+    return fired
+
+def test_timeout_order():
+    fired = []
+    def a(): fired.append('a')
+    def b(): fired.append('b')
+    def c(): fired.append('c')
+    def d(): fired.append('d')
+    wizard.timeout(a, 0.03)
+    wizard.timeout(b, 0.01)
+    removed = wizard.timeout(c, 0.02)
+    moved = wizard.timeout(d, 0.005)
+    wizard.remove_timeout(removed)
+    moved.reschedule(0.04)
+    while wizard.get_delta() is not None:
+        time.sleep(wizard.get_delta())
+        run_timeouts()
+    assert fired == ['b', 'a', 'd']
+
+def test_timeout_repeats():
+    fired = []
+    def tick():
+        fired.append(1)
+        if len(fired) == 3:
+            wizard.remove_timeout(timer)
+    timer = wizard.timeout(tick, 0, -1)
+    while wizard.get_delta() is not None:
+        run_timeouts()
+    assert len(fired) == 3
+
+def test_timeout_scale():
+    fired = []
+    def tick(): fired.append(1)
+    n = 20000
+    timers = [wizard.timeout(tick, -random.random()) for i in range(n)]
+    for v in timers[::2]:
+        wizard.remove_timeout(v)
+    for v in timers[1::4]:
+        v.reschedule(-random.random())
+    assert len(wizard.timeouts) <= n
+    order = [v.ts for v in wizard.get_timeouts()]
+    assert order == sorted(order)
+    assert len(order) == n // 2
+    assert wizard.get_delta() is None
+
 def test_wizard_gc_info():
     gc.collect()
     assert not wizard.info()